@@ -1,4 +1,7 @@
 import logging              # use instead of print for more control
+import time                 # timing of the bootstrap
+from concurrent.futures import ProcessPoolExecutor    # run the bootstrap in parallel
+from contextlib import ExitStack                       # optional process pool
 from pathlib import Path    # filesystem related stuff
 import numpy as np          # numerical computations
 from matplotlib.pyplot import subplots, figure, savefig
@@ -9,15 +12,22 @@ from astropy.table import Table
 
 from scipy.optimize import minimize
 from scipy.integrate import quad
+from scipy.special import ndtr               # cumulative normal distribution
+try:
+    from scipy.integrate import cumulative_trapezoid
+except ImportError:
+    # older versions of scipy
+    from scipy.integrate import cumtrapz as cumulative_trapezoid
 from inspect import signature
 
 from .constants import single_column,two_column,tab10
+from .diagnostics import classify, classification_probabilities, column_names, required, default_criteria
 from .old import MaximumLikelihood
 
 logger = logging.getLogger(__name__)
 
 
-def emission_line_diagnostics(table,distance_modulus,completeness_limit,SNR=True):
+def emission_line_diagnostics(table,distance_modulus,completeness_limit,SNR=True,criteria=None,n_draws=0,seed=None,copy=True):
     '''Classify objects based on their emission lines 
     
     we use four criteria to distinguish between PN, HII regions and SNR:
@@ -40,7 +50,7 @@ def emission_line_diagnostics(table,distance_modulus,completeness_limit,SNR=True
     Parameters
     ----------
     table : Astropy Table
-        Table with measured fluxes 
+        Table with measured fluxes (or a structured array / dict of arrays)
     
     completeness_limit : float
         Sources fainter than this magnitude are ignored
@@ -52,109 +62,73 @@ def emission_line_diagnostics(table,distance_modulus,completeness_limit,SNR=True
     SNR : bool
         remove supernovae remnants based on SII to HA ratio
 
+    criteria : dict
+        alternative set of criteria (see `diagnostics.classify`)
+
+    n_draws : int
+        if >0, the probability of each type is estimated from this number
+        of random realizations of the fluxes and saved in the column
+        `type_probability` (see `diagnostics.classification_probabilities`)
+
+    seed : int
+        seed for the random realizations
+
+    copy : bool
+        copy the columns of the input table. With `copy=False` the output
+        shares the columns with the input, i.e. changing a column of the
+        output in place (e.g. `tbl['dmOIII'] *= 2`) also changes the input.
+
     Returns
     -------
     table : Astropy Table
         The input table with an additional column, indicating the type of the object
+        (`type` with the name and `type_code` with the index in `table.meta['types']`)
     '''
     
     # we check if all columns exist
-    required = ['HB4861','OIII5006','HA6562','NII6583','SII6716','SII6730','mOIII']
-    missing = set(required) - set(table.columns)
+    missing = set(required) - set(column_names(table))
     if missing:
         raise KeyError(f'input table is missing {", ".join(missing)}')
     del missing
-       
-    # we don't want to modift the original input table
-    table = table.copy()
 
     logger.info(f'{len(table)} entries in initial catalogue')
     logger.info(f'using mu={distance_modulus:.2f}, cl={completeness_limit}')
 
-    # make sure that the new column can save strings with 3 characters
-    table['type'] = np.empty(len(table),dtype='U3')
-    # we start with the assumption that all sources are PN and remove contaminants later
-    table['type'][:] = 'PN'
-
-    # calculate the absolute magnitude based on a first estimate of the distance modulus 
-    table['MOIII'] = table['mOIII'] - distance_modulus
-    table['SII'] = table['SII6716']+table['SII6730']
-    table['SII_err'] = np.sqrt(table['SII6716_err']**2+table['SII6730_err']**2)
-
-    # we set negative fluxes to the error (0 would cause because we work with ratios)
-    for col in ['HB4861','OIII5006','HA6562','NII6583','SII']:
-        # median of error maps is a factor of 3 smaller than std of maps
-        detection = (table[col]>0) & (table[col]>9*table[f'{col}_err'])
-        #logger.info(f'{np.sum(~detection)} not detected in {col}')
-        table[col][np.where(table[col]<0)] = table[f'{col}_err'][np.where(table[col]<0)] 
-        #table[col][np.where(~detection)] = table[f'{col}_err'][np.where(~detection)] 
-        table[f'{col}_detection'] = detection
-
-    # calculate velocity dispersion (use line with best signal to noise)
-    table['OIII5006_S/N'] =  table['OIII5006']/table['OIII5006_err']
-    table['HA6562_S/N']   =  table['HA6562']/table['HA6562_err']
-    table['SII_S/N']  =  table['SII']/table['SII_err'] 
-
-    # use the velocity dispersion with the highest singal to noise
-    table['v_SIGMA']     = table['HA6562_SIGMA']
-    table['v_SIGMA_S/N'] = table['HA6562_S/N']
-
-    #table['v_SIGMA'][np.where(table['HA6562_SIGMA']/table['HA6562_SIGMA_ERR']>table['v_SIGMA_S/N'] )] = table['HA6562_SIGMA'][np.where(table['HA6562_SIGMA']/table['HA6562_SIGMA_ERR']>table['v_SIGMA_S/N'] )]
-    #table['v_SIGMA_S/N'][np.where(table['HA6562_SIGMA']/table['HA6562_SIGMA_ERR']>table['v_SIGMA_S/N'] )] = table['HA6562_S/N'][np.where(table['HA6562_SIGMA']/table['HA6562_SIGMA_ERR']>table['v_SIGMA_S/N'] )] 
-    #table['v_SIGMA'][np.where(table['SII6716_SIGMA']/table['SII6716_SIGMA_ERR']>table['v_SIGMA_S/N'])] = table['SII6716_SIGMA'][np.where(table['SII6716_SIGMA']/table['SII6716_SIGMA_ERR']>table['v_SIGMA_S/N'] )]
-    #table['v_SIGMA_S/N'][table['SII6716_SIGMA']/table['SII6716_SIGMA_ERR']>table['v_SIGMA_S/N'] )] = table['SII_S/N'][np.where(table['SII6716_SIGMA']/table['SII6716_SIGMA_ERR']>table['v_SIGMA_S/N'] )] 
-    #logger.info('v_sigma: median={:.2f}, median={:.2f}, sig={:.2f}'.format(*sigma_clipped_stats(table['v_SIGMA'][~np.isnan(table['v_SIGMA'])])))
-    
-    # define ratio of OIII to Halpha and NII for the first criteria (with error). If NII is not detected we assume NII=0.5Halpha
-    table['R']  =  np.log10(table['OIII5006'] / (table['HA6562']+table['NII6583']))
-    table['R'][~table['NII6583_detection']] = np.log10(table['OIII5006'][~table['NII6583_detection']] / (1.5*table['HA6562'][~table['NII6583_detection']])) 
-    table['dR'] = np.sqrt((table['OIII5006_err'] / table['OIII5006'])**2 + (table['HA6562_err'] / (table['HA6562']+table['NII6583']))**2 + (table['NII6583_err'] / (table['HA6562']+table['NII6583']))**2) /np.log(10) 
-
-    # define criterias to exclude non PN objects
-    criteria = {}
-
-    if True:
-        # this ignores the uncertainties
-        #criteria['HII'] = (10**(table['R']) < 1.6)
-        criteria[''] = (4 < (table['R'])) #& (table['HA6562_detection'])
-        criteria['HII'] = (table['R'] < -0.37*table['MOIII'] - 1.16) & (table['HA6562_detection'] | table['NII6583_detection'])
-    elif True:
-        # use HB as a criteria (because this line is close to OIII, extinction should not be an issue)
-        criteria['HII'] = (np.log10(table['OIII5006'] / table['HB4861']) < -0.37*table['MOIII'] - 0.71) & table['HB4861_detection'] 
-    else:
-        # here we retain things in the sample if they are within 3 sigma
-        criteria[''] = (4 < (table['R']- 3*table['dR'])) #& (table['HA6562_detection'])
-        criteria['HII'] = (table['R'] + 3*table['dR'] < -0.37*table['MOIII'] - 1.16) & (table['HA6562_detection'] | table['NII6583_detection'])
-
-    criteria['SNR'] = ((table['HA6562']) /table['SII'] < 2.5) & (table['SII_detection']) 
-    # only apply this criteria if signal to noise is < 3
-    # we underestimate the error and hence S/N is too big. This justifies using 3 instead of 1
-    criteria['SNR'] |= ((table['v_SIGMA']>100) & (table['v_SIGMA_S/N']>3)) # & (table['HA6562_S/N']<3)
+    codes, types, columns = classify(table,distance_modulus,criteria=criteria)
 
-    # objects that would be classified as PN by narrowband observations
-    table['SNRorPN'] = criteria['SNR'] & ~criteria['HII']
+    # we don't want to modify the original input table (with copy=False
+    # the columns are shared and only the new ones are added to the output)
+    out = Table(table,copy=copy)
+    out.meta = dict(out.meta)
+    out.meta['types'] = types
+    out['type'] = np.array(types)[codes]
+    out['type_code'] = codes
+    for col,values in columns.items():
+        out[col] = values
 
-    for k in criteria.keys():
-        table['type'][np.where(criteria[k])] = k
+    # objects that would be classified as PN by narrowband observations
+    criteria = default_criteria if criteria is None else criteria
+    if 'SNR' in criteria and 'HII' in criteria:
+        with np.errstate(invalid='ignore'):
+            out['SNRorPN'] = criteria['SNR'](columns) & ~criteria['HII'](columns)
 
-    # remove rows with NaN values in some columns
-    mask =  np.ones(len(table), dtype=bool)
-    for col in required:
-        mask &=  ~np.isnan(table[col])
-    table['type'][np.where(~mask)] = 'NaN'
-    #table = table[mask]
-    #logger.info(f'{np.sum(~mask)} rows contain NaN values')
+    if n_draws:
+        out['type_probability'],_ = classification_probabilities(table,distance_modulus,n_draws=n_draws,
+                                                                 criteria=criteria,seed=seed)
 
     # purely for information
-    mask = table['mOIII']< completeness_limit
-    logger.info(f'{np.sum(~mask)} objects below the completness limit of {completeness_limit}')    
+    complete = np.asarray(table['mOIII']) < completeness_limit
+    logger.info(f'{np.sum(~complete)} objects below the completness limit of {completeness_limit}')
+
+    counts = np.bincount(codes,minlength=len(types))
+    counts_complete = np.bincount(codes[complete],minlength=len(types))
+    for i,k in [*enumerate(types)][1:-1] + [(0,'PN')]:
+        if k=='':
+            logger.info(f'{counts[i]} objects classified as 4<log [OIII]/Ha')
+        else:
+            logger.info(f'{counts[i]} ({counts_complete[i]}) objects classified as {k}')
 
-    logger.info(f'{len(table[table["type"]==""])} objects classified as 4<log [OIII]/Ha')
-    logger.info(f'{len(table[table["type"]=="HII"])} ({len(table[(table["type"]=="HII") & (table["mOIII"]<completeness_limit)])}) objects classified as HII')
-    logger.info(f'{len(table[table["type"]=="SNR"])} ({len(table[(table["type"]=="SNR") & (table["mOIII"]<completeness_limit)])}) objects classified as SNR')
-    logger.info(f'{len(table[table["type"]=="PN"])} ({len(table[(table["type"]=="PN") & (table["mOIII"]<completeness_limit)])}) objects classified as PN')
-    
-    return table
+    return out
 
 def gaussian(x,mu,sig):
     return 1/np.sqrt(2*np.pi*sig**2) * np.exp(-(x-mu)**2/(2*sig**2))
@@ -210,6 +184,15 @@ class MaximumLikelihood1D:
         idx_high = np.argmax(self.data)
         if np.any(err):
             self.grid = np.linspace(self.data[idx_low]-width*self.err[idx_low],self.data[idx_high]+width*self.err[idx_high],size)
+
+            # the gaussian error of each data point multiplied with the
+            # weights of the trapezoidal rule (data x grid). The integral
+            # for all data points is then a single matrix-vector product
+            weights = np.empty(size)
+            weights[1:-1] = (self.grid[2:]-self.grid[:-2])/2
+            weights[0], weights[-1] = (self.grid[1]-self.grid[0])/2, (self.grid[-1]-self.grid[-2])/2
+            data, err = np.asarray(self.data,dtype=float), np.asarray(self.err,dtype=float)
+            self.kernel = gaussian(self.grid[None,:],data[:,None],err[:,None]) * weights
         
     def prior(self,*args):
         '''uniform prior'''
@@ -222,12 +205,56 @@ class MaximumLikelihood1D:
         #return -np.sum(np.log([quad(lambda x: self.func(x,param,**self.kwargs)*gaussian(x,d,e),d-5*e,d+5*e)[0] for d,e in zip(self.data,self.err)]))
         
         if np.any(self.err):
-            ev = [np.trapz(self.func(self.grid,param,**self.kwargs)*gaussian(self.grid,d,e),self.grid) for d,e in zip(self.data,self.err)]                
+            ev = self.kernel @ self.func(self.grid,param,**self.kwargs)
             return np.sum(np.log(ev))
         else:
             ev = self.func(self.data,param,**self.kwargs)
             return np.sum(np.log(ev))
         
+    def evidence_grid(self,params):
+        '''the evidence for an array of parameters
+
+        `func` is evaluated for all parameters at once if it supports 
+        broadcasting (`func(data[None,:],params[:,None])`). Otherwise it 
+        is called once for each parameter.
+        '''
+
+        params = np.asarray(params,dtype=float)
+        x = self.grid if np.any(self.err) else np.asarray(self.data,dtype=float)
+
+        # only the errors of a failed broadcast are caught (other errors
+        # in `func` are raised)
+        try:
+            pdf = self.func(x[None,:],params[:,None],**self.kwargs)
+        except (ValueError,TypeError,IndexError):
+            pdf = None
+        if np.shape(pdf) != (len(params),len(x)):
+            self._log_fallback('func')
+            pdf = np.array([self.func(x,p,**self.kwargs) for p in params])
+
+        ev = pdf @ self.kernel.T if np.any(self.err) else pdf 
+        return np.sum(np.log(ev),axis=1)
+
+    def prior_grid(self,params):
+        '''the prior for an array of parameters'''
+
+        params = np.asarray(params,dtype=float)
+        try:
+            prior = np.broadcast_to(self.prior(params),params.shape).astype(float)
+        except (ValueError,TypeError,IndexError):
+            self._log_fallback('prior')
+            prior = np.array([self.prior(p) for p in params],dtype=float)
+
+        return prior
+
+    def _log_fallback(self,name):
+        '''log (once per fitter) that `name` is called for each parameter'''
+
+        fallback = self.__dict__.setdefault('_fallback',set())
+        if name not in fallback:
+            fallback.add(name)
+            logger.info(f'`{name}` does not support broadcasting and is evaluated for each parameter')
+
     def likelihood(self,param):
         '''the evidence multiplied with some prior'''
         
@@ -247,10 +274,13 @@ class MaximumLikelihood1D:
         #    print(f'{name} = {_x:.3f} + {_dx[1]:.3f} - {_dx[0]:.3f} ')
         size = 0.5
         self.x_arr = np.linspace(self.x-size,self.x+size,1000)
-        # evidence and likelihood are in log 
-        self.evidence_arr   = np.exp([self.evidence(_) for _ in self.x_arr])
-        self.prior_arr      = np.array([self.prior(_) for _ in self.x_arr])
-        self.likelihood_arr = np.exp([-self.likelihood(_) for _ in self.x_arr])
+        # evidence and likelihood are in log (the maximum is subtracted 
+        # to avoid an underflow. This cancels in the normalization)
+        log_evidence = self.evidence_grid(self.x_arr)
+        self.prior_arr      = self.prior_grid(self.x_arr)
+        log_likelihood = log_evidence + np.log(self.prior_arr)
+        self.evidence_arr   = np.exp(log_evidence-np.nanmax(log_evidence))
+        self.likelihood_arr = np.exp(log_likelihood-np.nanmax(log_likelihood))
  
         valid = ~np.isnan(self.evidence_arr) &  ~np.isnan(self.likelihood_arr) 
         self.evidence_arr   /= np.abs(np.trapz(self.evidence_arr[valid],self.x_arr [valid]))
@@ -258,7 +288,7 @@ class MaximumLikelihood1D:
         self.likelihood_arr /= np.abs(np.trapz(self.likelihood_arr[valid],self.x_arr [valid]))
 
         normalization = np.trapz(self.likelihood_arr,self.x_arr )
-        self.integral = np.array([np.trapz(self.likelihood_arr[self.x_arr<=xp],self.x_arr[self.x_arr<=xp])/normalization for xp in self.x_arr[1:]])
+        self.integral = cumulative_trapezoid(self.likelihood_arr,self.x_arr) / normalization
        
         # 1 sigma interval for cumulative likelihood
         self.mid = np.argmin(np.abs(self.integral-0.5))
@@ -272,6 +302,222 @@ class MaximumLikelihood1D:
 
         return self.x,self.plus,self.minus
 
+    def bootstrap(self,guess=None,n_samples=100,kind='bootstrap',seed=None,workers=1):
+        '''estimate the uncertainty of the fit by resampling the data
+
+        The fit is repeated for many resampled data sets. The resampled
+        data sets are created one after another (in the main process) 
+        from a single random number generator, so the result only depends
+        on `seed` (and not on the number of workers). Keyword arguments of `func` that have one
+        value for each data point (e.g. `dm` for `pnlf_convolved`) are 
+        resampled together with the data.
+
+        Parameters
+        ----------
+        guess : list
+            initial guess for the minimization (default is the result of 
+            `fit`, required if `fit` was not run)
+
+        n_samples : int
+            number of resampled data sets (ignored for `jackknife`)
+
+        kind : str
+            `bootstrap` (draw data points with replacement), `parametric`
+            (draw new data from the gaussian errors) or `jackknife` 
+            (leave out one data point at a time)
+
+        seed : int
+            seed for the random number generator
+
+        workers : int
+            number of processes that are used for the fits
+
+        Returns
+        -------
+        x, plus, minus : float
+            best fit and uncertainties. For `bootstrap` and `parametric`
+            the uncertainties are given by the 15.85 and 84.15 percentiles
+            and for `jackknife` by the jackknife standard error.
+        '''
+
+        if kind not in ['bootstrap','parametric','jackknife']:
+            raise ValueError(f'unknown kind {kind}')
+        if kind=='parametric' and not np.any(self.err):
+            raise ValueError('parametric bootstrap requires `err`')
+
+        if not hasattr(self,'x'):
+            if guess is None:
+                raise ValueError('`guess` is required if `fit` was not run')
+            self.fit(guess)
+        guess = [self.x] if guess is None else guess
+
+        data = np.asarray(self.data,dtype=float)
+        err  = np.asarray(self.err,dtype=float) if np.any(self.err) else None
+        N = len(data)
+
+        seed_sequence = np.random.SeedSequence(seed)
+        logger.info(f'{kind} with seed={seed_sequence.entropy}')
+        rng = np.random.default_rng(seed_sequence)
+
+        # the resampled data sets are created one at a time (the jackknife
+        # only passes the index of the data point that is left out)
+        if kind == 'jackknife':
+            n_samples = N
+            samples = ((i,None) for i in range(N))
+        elif kind == 'bootstrap':
+            samples = ((rng.integers(0,N,N),None) for _ in range(n_samples))
+        else:
+            samples = ((None,rng.normal(data,err)) for _ in range(n_samples))
+            
+        # the prior is only passed on if it was specified by the user
+        context = {'func':self.func,'data':data,'err':err,'prior':self.__dict__.get('prior'),
+                   'method':self.method,'kwargs':self.kwargs,'guess':guess,
+                   'per_point':{k for k,v in self.kwargs.items() if np.shape(v)==(N,)}}
+        
+        start = time.time()
+        results = []
+        with ExitStack() as stack:
+            # the workers are shut down even if a fit raises
+            if workers > 1:
+                executor = stack.enter_context(ProcessPoolExecutor(max_workers=workers,initializer=_init_bootstrap_worker,initargs=(context,)))
+                fits = executor.map(_fit_sample,samples,chunksize=max(1,n_samples//(10*workers)))
+            else:
+                fits = (_fit_sample(sample,context) for sample in samples)
+
+            for i,result in enumerate(fits):
+                results.append(result)
+                if (i+1) % max(1,n_samples//10) == 0:
+                    logger.info(f'{i+1} of {n_samples} samples ({time.time()-start:.1f}s)')
+
+        duration = time.time()-start
+        logger.info(f'{n_samples} fits in {duration:.1f}s ({duration/n_samples*1e3:.0f}ms per fit)')
+
+        self.samples = np.array(results)
+        valid = np.isfinite(self.samples)
+        if not np.all(valid):
+            logger.warning(f'{np.sum(~valid)} of {n_samples} fits were not successful')
+
+        if kind == 'jackknife':
+            std = np.sqrt((N-1)/N * np.sum((self.samples[valid]-np.mean(self.samples[valid]))**2))
+            plus, minus = std, std
+        else:
+            low, high = np.percentile(self.samples[valid],[15.85,84.15])
+            plus, minus = high-self.x, self.x-low
+
+        return self.x, plus, minus
+
+    def sample(self,guess=None,nwalkers=32,nsteps=2000,discard=None,filename=None,name='mcmc',resume=True,
+               seed=None,workers=1,progress=False):
+        '''sample the posterior with emcee
+
+        The log probability is evaluated for all walkers at once (with 
+        `vectorize=True` and `evidence_grid`). With `workers>1` the 
+        walkers are split between multiple processes. If a `filename` is
+        given, the chain is saved to disk (with `emcee.backends.HDFBackend`,
+        requires h5py) and an existing chain is continued.
+
+        Parameters
+        ----------
+        guess : list
+            the walkers are initialized around this value (default is the
+            result of `fit`)
+
+        nwalkers : int
+            number of walkers
+
+        nsteps : int
+            number of steps (in addition to the existing steps if the
+            chain is resumed)
+
+        discard : int
+            number of steps that are discarded as burn-in (default is a 
+            quarter of the chain)
+
+        filename : str
+            the chain is saved to this `.h5` file
+
+        name : str
+            name of the group in the file (multiple chains can be saved to
+            the same file)
+
+        resume : bool
+            continue an existing chain in `filename` (otherwise it is 
+            overwritten)
+
+        seed : int
+            seed for the random number generator
+
+        workers : int
+            number of processes that evaluate the log probability
+
+        Returns
+        -------
+        x, plus, minus : float
+            median and the uncertainties given by the 15.85 and 84.15 
+            percentiles of the posterior
+        '''
+
+        import emcee
+
+        if guess is None:
+            if not hasattr(self,'x'):
+                raise ValueError('`guess` is required if `fit` was not run')
+            guess = [self.x]
+        ndim = len(guess)
+        if ndim != 1:
+            raise ValueError('only functions with one free parameter are supported')
+
+        seed_sequence = np.random.SeedSequence(seed)
+        logger.info(f'mcmc with seed={seed_sequence.entropy}')
+        rng = np.random.default_rng(seed_sequence)
+
+        backend, iteration = None, 0
+        if filename:
+            backend = emcee.backends.HDFBackend(filename,name=name)
+            try:
+                iteration = backend.iteration if resume else 0
+            except (OSError,KeyError):
+                # the file or the group does not exist yet
+                iteration = 0
+            if iteration == 0:
+                backend.reset(nwalkers,ndim)
+            elif backend.shape != (nwalkers,ndim):
+                raise ValueError(f'the chain in {filename} has the shape {backend.shape}')
+
+        random_state = np.random.RandomState(np.random.MT19937(rng.integers(2**32))).get_state()
+        if iteration > 0:
+            logger.info(f'resume chain with {iteration} steps from {filename}')
+            initial_state = None
+        else:
+            initial_state = np.asarray(guess,dtype=float) + 1e-3*rng.standard_normal((nwalkers,ndim))
+
+        start = time.time()
+        with ExitStack() as stack:
+            if workers > 1:
+                # the workers create their own fitter from the data (the 
+                # fitter itself is not sent to the workers)
+                initargs = (self.func,self.data,self.err,self.__dict__.get('prior'),self.kwargs)
+                executor = stack.enter_context(ProcessPoolExecutor(max_workers=workers,initializer=_init_mcmc_worker,initargs=initargs))
+                kwargs = {'executor':executor,'workers':workers}
+            else:
+                kwargs = {'fitter':self}
+
+            self.sampler = emcee.EnsembleSampler(nwalkers,ndim,_walker_log_probability,kwargs=kwargs,vectorize=True,backend=backend)
+            self.sampler.random_state = random_state
+            self.sampler.run_mcmc(initial_state,nsteps,progress=progress)
+        duration = time.time()-start
+        logger.info(f'{nsteps} steps in {duration:.1f}s (acceptance fraction {np.mean(self.sampler.acceptance_fraction):.2f})')
+
+        iterations = self.sampler.iteration
+        discard = iterations//4 if discard is None else discard
+        tau = self.sampler.get_autocorr_time(discard=discard,quiet=True)
+        logger.info(f'autocorrelation time {np.max(tau):.1f} steps ({iterations} steps in chain)')
+
+        self.chain = self.sampler.get_chain(discard=discard,flat=True)[:,0]
+        low,mid,high = np.percentile(self.chain,[15.85,50,84.15])
+
+        return mid, high-mid, mid-low
+
     def plot(self,limits=[]):
         '''plot the likelihood
         
@@ -327,6 +573,287 @@ class MaximumLikelihood1D:
         return self.fit(guess)
 
 
+# the fitter in each worker process (see `_init_mcmc_worker`)
+_mcmc_context = {}
+
+def _init_mcmc_worker(func,data,err,prior,kwargs):
+    '''create the fitter in each worker (only done once per process)'''
+
+    _mcmc_context['fitter'] = MaximumLikelihood1D(func,data,err=err,prior=prior,**kwargs)
+
+
+def _log_probability(params,fitter=None):
+    '''log probability for an array of parameters (used by `MaximumLikelihood1D.sample`)
+
+    Must be defined at the module level so it can be executed in a 
+    worker process.
+    '''
+
+    fitter = _mcmc_context['fitter'] if fitter is None else fitter
+    with np.errstate(divide='ignore',invalid='ignore'):
+        log_prob = fitter.evidence_grid(params) + np.log(fitter.prior_grid(params))
+
+    return np.where(np.isnan(log_prob),-np.inf,log_prob)
+
+
+def _walker_log_probability(params,fitter=None,executor=None,workers=1):
+    '''log probability of all walkers (the function that is passed to emcee)
+
+    With an `executor`, the walkers are split between `workers` 
+    processes (that were initialized with `_init_mcmc_worker`). 
+    Otherwise the log probability is computed with `fitter`.
+    '''
+
+    if executor is None:
+        return _log_probability(params[:,0],fitter)
+
+    chunks = np.array_split(params[:,0],workers)
+    return np.concatenate(list(executor.map(_log_probability,chunks)))
+
+
+# the data of the worker processes in `MaximumLikelihood1D.bootstrap`
+# (set once per process by `_init_bootstrap_worker`)
+_bootstrap_context = {}
+
+def _init_bootstrap_worker(context):
+    _bootstrap_context.update(context)
+
+
+def _fit_sample(sample,context=None):
+    '''fit a single resampled data set (used by `MaximumLikelihood1D.bootstrap`)
+
+    Must be defined at the module level so it can be executed in a 
+    worker process. Returns NaN if the fit fails.
+
+    Parameters
+    ----------
+    sample : tuple
+        `(index,new_data)`. `index` is either an array with the indices 
+        of the data points, a single index of a data point that is left
+        out or None (all data points). If `new_data` is not None, it 
+        replaces the data.
+
+    context : dict
+        data and parameters of the fitter (see `bootstrap`). Uses the 
+        context of the worker process if None.
+    '''
+
+    c = _bootstrap_context if context is None else context
+    index, new_data = sample
+    data, err = c['data'], c['err']
+
+    if index is None:
+        index = slice(None)
+    elif np.ndim(index) == 0:
+        index = np.delete(np.arange(len(data)),index)
+
+    kwargs = {k:(np.asarray(v)[index] if k in c['per_point'] else v) for k,v in c['kwargs'].items()}
+    fitter = MaximumLikelihood1D(c['func'],data[index] if new_data is None else new_data,
+                                 err=None if err is None else err[index],prior=c['prior'],method=c['method'],**kwargs)
+    result = minimize(fitter.likelihood,c['guess'],method=c['method'])
+
+    return result.x[0] if result.success else np.nan
+
+
+class JointMaximumLikelihood:
+    '''fit the PNLF of several galaxies with a shared Mmax
+
+    The distance moduli of all galaxies and Mmax are fitted at once. The
+    likelihood is vectorized over all galaxies and the gradient is
+    calculated analytically, so the fit also converges quickly for many 
+    galaxies.
+
+    The normalized PNLF only depends on the cutoff c=mu+Mmax. Hence the 
+    distances and Mmax can only be separated with priors, either on the 
+    distance of some galaxies (e.g. from the TRGB) or on Mmax itself. 
+    With c the log likelihood of each galaxy is
+
+    sum_j log g(m_j-c) - n log N(mhigh-c)
+
+    with g(y)=e^0.307y - e^-2.693y (or its convolution with the errors,
+    see `pnlf_convolved`) and N the integral of g from 0 to mhigh-c. 
+    The derivative with respect to c is
+
+    -sum_j (0.307 I_0.307 + 2.693 I_-2.693) / g_j + n g(mhigh-c) / N
+
+    where I_k is the (convolved) integral of the exponential e^ky.
+
+    Parameters
+    ----------
+    data : list
+        apparent magnitudes of the PNs (one array for each galaxy)
+
+    mhigh : ndarray
+        completeness level of each galaxy
+
+    dm : list
+        uncertainty of each magnitude (one array for each galaxy). If
+        None, the PNLF is not convolved with the errors.
+
+    mu_prior : ndarray
+        distance modulus that is used as gaussian prior for each galaxy
+        (NaN for galaxies without a prior)
+
+    mu_prior_err : ndarray
+        width of the prior for the distance modulus
+
+    Mmax : float
+        initial guess for Mmax and center of its prior
+
+    Mmax_err : float
+        width of the prior for Mmax (None for a flat prior and 0 to keep
+        Mmax fixed)
+
+    names : list
+        name of each galaxy (used for the output)
+    '''
+
+    def __init__(self,data,mhigh,dm=None,mu_prior=None,mu_prior_err=None,Mmax=-4.47,Mmax_err=None,names=None):
+
+        n_galaxies = len(data)
+        self.names  = list(names) if names is not None else [f'{i}' for i in range(n_galaxies)]
+        self.N      = np.array([len(d) for d in data])
+        self.mhigh  = np.broadcast_to(np.asarray(mhigh,dtype=float),(n_galaxies,)).copy()
+
+        # all galaxies are concatenated and `index` maps each PN to its galaxy
+        self.index  = np.repeat(np.arange(n_galaxies),self.N)
+        self.data   = np.concatenate([np.asarray(d,dtype=float) for d in data])
+        self.dm     = None if dm is None else np.concatenate([np.asarray(e,dtype=float) for e in dm])
+
+        self.mu_prior     = np.full(n_galaxies,np.nan) if mu_prior is None else np.asarray(mu_prior,dtype=float)
+        self.mu_prior_err = np.full(n_galaxies,np.nan) if mu_prior_err is None else np.asarray(mu_prior_err,dtype=float)
+        self.Mmax0    = Mmax
+        self.Mmax_err = Mmax_err
+
+        self.fixed = Mmax_err == 0
+        self.has_prior = ~np.isnan(self.mu_prior) & ~np.isnan(self.mu_prior_err)
+        if Mmax_err is None and not np.any(self.has_prior):
+            raise ValueError('Mmax is degenerate with the distances. Use `mu_prior` or `Mmax_err`')
+
+        logger.info(f'initialize joint fitter with {n_galaxies} galaxies and {len(self.data)} data points')
+
+    def evidence(self,c):
+        '''log likelihood of each galaxy and its derivative with respect to the cutoff c'''
+
+        a, b = 0.307, 2.693
+        Y = self.mhigh - c
+        normalization = (np.exp(a*Y)-1)/a + (np.exp(-b*Y)-1)/b
+        dnormalization = -(np.exp(a*Y) - np.exp(-b*Y))
+
+        cutoff, mhigh = c[self.index], self.mhigh[self.index]
+        y = self.data - cutoff
+        with np.errstate(divide='ignore',invalid='ignore',over='ignore'):
+            if self.dm is None:
+                Ia, Ib = np.exp(a*y), np.exp(-b*y)
+                inside = (y>=0) & (self.data<=mhigh)
+                Ia, Ib = np.where(inside,Ia,0), np.where(inside,Ib,0)
+            else:
+                s = self.dm
+                def integral(k):
+                    shift = self.data + k*s**2
+                    return np.exp(k*y+k**2*s**2/2) * _normal_interval((cutoff-shift)/s,(mhigh-shift)/s)
+                Ia, Ib = integral(a), integral(-b)
+
+            g  = Ia - Ib
+            dg = -(a*Ia + b*Ib)
+
+            n_galaxies = len(c)
+            log_evidence  = np.bincount(self.index,weights=np.log(g),minlength=n_galaxies) - self.N*np.log(normalization)
+            dlog_evidence = np.bincount(self.index,weights=dg/g,minlength=n_galaxies) - self.N*dnormalization/normalization
+
+        return log_evidence, dlog_evidence
+
+    def likelihood(self,params):
+        '''negative log likelihood (with priors) and its gradient
+
+        params are the distance moduli of all galaxies followed by Mmax
+        (only the distance moduli if Mmax is fixed)
+        '''
+
+        params = np.asarray(params,dtype=float)
+        mu, Mmax = (params, self.Mmax0) if self.fixed else (params[:-1], params[-1])
+
+        log_evidence, dlog_evidence = self.evidence(mu+Mmax)
+        if not np.all(np.isfinite(log_evidence)):
+            return np.inf, np.zeros_like(params)
+
+        value = -np.sum(log_evidence)
+        grad  = np.append(-dlog_evidence,-np.sum(dlog_evidence))
+
+        # gaussian priors
+        p = self.has_prior
+        value += np.sum((mu[p]-self.mu_prior[p])**2 / (2*self.mu_prior_err[p]**2))
+        grad[:-1][p] += (mu[p]-self.mu_prior[p]) / self.mu_prior_err[p]**2
+        if self.fixed:
+            return value, grad[:-1]
+        if self.Mmax_err is not None:
+            value += (Mmax-self.Mmax0)**2 / (2*self.Mmax_err**2)
+            grad[-1] += (Mmax-self.Mmax0) / self.Mmax_err**2
+
+        return value, grad
+
+    def hessian(self,params,step=1e-5):
+        '''hessian from finite differences of the analytic gradient'''
+
+        params = np.asarray(params,dtype=float)
+        hessian = np.empty((len(params),len(params)))
+        for i in range(len(params)):
+            dx = np.zeros_like(params)
+            dx[i] = step
+            hessian[:,i] = (self.likelihood(params+dx)[1] - self.likelihood(params-dx)[1]) / (2*step)
+
+        return (hessian+hessian.T)/2
+
+    def fit(self,guess=None,method='BFGS'):
+        '''find the best parameters with scipy minimize
+
+        The uncertainties are estimated from the inverse of the hessian.
+
+        Parameters
+        ----------
+        guess : ndarray
+            initial guess for the distance moduli followed by Mmax (not
+            if Mmax is fixed). The default are the priors (or based on 
+            the brightest PN in each galaxy).
+
+        Returns
+        -------
+        table : Astropy Table
+            the distance modulus of each galaxy. Mmax and its uncertainty
+            are saved in `table.meta`.
+        '''
+
+        if guess is None:
+            brightest = np.array([np.min(self.data[self.index==i]) for i in range(len(self.N))])
+            mu = np.where(self.has_prior,self.mu_prior,brightest-self.Mmax0-0.01)
+            # without errors, no PN can be brighter than the cutoff
+            Mmax = self.Mmax0 if self.dm is not None else min(self.Mmax0,np.min(brightest-mu)-0.01)
+            guess = mu if self.fixed else np.append(mu,Mmax)
+
+        start = time.time()
+        self.result = minimize(self.likelihood,guess,jac=True,method=method)
+        if not self.result.success:
+            raise RuntimeError(f'fit was not successful ({self.result.message})')
+        logger.info(f'fit converged after {self.result.nit} iterations ({time.time()-start:.2f}s)')
+
+        self.covariance = np.linalg.inv(self.hessian(self.result.x))
+        self.x, self.x_err = self.result.x, np.sqrt(np.diag(self.covariance))
+        if self.fixed:
+            self.x, self.x_err = np.append(self.x,self.Mmax0), np.append(self.x_err,0)
+
+        table = Table({'name':self.names,'N_PN':self.N,'mu':self.x[:-1],'mu_err':self.x_err[:-1]})
+        table.meta['Mmax'] = self.x[-1]
+        table.meta['Mmax_err'] = self.x_err[-1]
+        logger.info(f'Mmax={self.x[-1]:.3f}+-{self.x_err[-1]:.3f}')
+
+        return table
+
+    def __call__(self,guess=None):
+        '''use scipy minimize to find the best parameters'''
+
+        return self.fit(guess)
+
+
 def f(m,mu,Mmax=-4.47):
     '''luminosity function (=density)'''
     
@@ -360,12 +887,15 @@ def pnlf(m,mu,mhigh,Mmax=-4.47):
     mhigh : float
         completeness level (magnitude of the faintest sources that
         are consistently detected). Required for normalization.
+
+    Mmax : float
+        Magnitude of the brightest PN.
     '''
 
     m = np.atleast_1d(m)
     mlow = Mmax+mu
     
-    normalization = 1/(F(mhigh,mu) - F(mlow,mu))    
+    normalization = 1/(F(mhigh,mu,Mmax=Mmax) - F(mlow,mu,Mmax=Mmax))    
     out = normalization * np.exp(0.307*(m-mu)) * (1-np.exp(3*(Mmax-m+mu)))
     out[(m>mhigh) | (m<mlow)] = 0
     
@@ -416,14 +946,76 @@ def cdf(x,mu,mhigh,Mmax = -4.47):
     
     return out
 
-def sample_pnlf(size,mu,cl):
+def _normal_interval(lower,upper):
+    '''probability that a standard normal variable lies in [lower,upper]'''
+
+    # for positive arguments the difference is computed in the other
+    # tail to avoid cancellation
+    flip = lower > 0
+    return np.where(flip,ndtr(-lower)-ndtr(-upper),ndtr(upper)-ndtr(lower))
+
+
+def pnlf_convolved(m,mu,mhigh,dm,Mmax=-4.47):
+    '''PNLF convolved with a Gaussian measurement error
+
+    The PNLF is a sum of two exponentials and the convolution with a 
+    Gaussian has a closed form in terms of the error function
+
+    int_mlow^mhigh e^c(x-mu) N(x|m,dm) dx = e^(c(m-mu)+c^2 dm^2/2) *
+        [Phi((mhigh-m-c dm^2)/dm) - Phi((mlow-m-c dm^2)/dm)]
+
+    The true magnitudes are truncated at the completeness limit `mhigh`
+    (like in `pnlf`). This is the exact version of the numerical 
+    integration that `MaximumLikelihood1D` does with `err`, e.g. 
+
+    MaximumLikelihood1D(pnlf_convolved,data,mhigh=mhigh,dm=err)
+
+    Parameters
+    ----------
+    m : ndarray
+        observed apparent magnitudes of the PNs
+        
+    mu : float
+        distance modulus
+
+    mhigh : float
+        completeness level 
+
+    dm : ndarray
+        uncertainty of each magnitude (same shape as m)
+
+    Mmax : float
+        Magnitude of the brightest PN.
+    '''
+
+    m  = np.atleast_1d(m)
+    mlow = Mmax+mu
     
-    Nbins = 1000
-    x =np.linspace(mu-4.47,cl,Nbins)
-    cdf = np.cumsum(pnlf(x,mu,cl))*(cl-mu+4.47)/Nbins
-    u = np.random.uniform(size=size)
+    normalization = 1/(F(mhigh,mu,Mmax=Mmax) - F(mlow,mu,Mmax=Mmax))    
+
+    with np.errstate(divide='ignore',invalid='ignore'):
+        def integral(c):
+            shift = m + c*dm**2
+            return np.exp(c*(m-mu)+c**2*dm**2/2) * _normal_interval((mlow-shift)/dm,(mhigh-shift)/dm)
+
+        out = normalization * (integral(0.307) - np.exp(3*Mmax)*integral(-2.693))
+
+    return out
+
+
+def sample_pnlf(size,mu,cl,rng=None):
+    '''draw random magnitudes from the PNLF
     
-    return np.interp(u,cdf,x)
+    The magnitudes are drawn with the exact inverse of the cumulative 
+    distribution (see `sampling.sample_pnlf`).
+
+    rng : numpy.random.Generator
+        random number generator (the global numpy state is used if None)
+    '''
+
+    from .sampling import sample_pnlf
+
+    return sample_pnlf(size,mu,cl,rng=rng)
 
 '''
 from scipy.stats import ks_2samp
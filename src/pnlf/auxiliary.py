@@ -353,30 +353,12 @@ def resolution_from_wcs(wcs):
 def sample_numerical(x,y,N=100,plot=False):
     '''sample from a PDF given by two arrays
 
+    see `sampling.sample_numerical`
     '''
 
-    xmin,xmax = np.min(x),np.max(x)
-    ymin,ymax = np.min(y),np.max(y)
+    from .sampling import sample_numerical
 
-    sample = []
-    
-    while len(sample)<N:
-        
-        x0 = np.random.uniform(xmin,xmax)
-        y0 = np.interp(x0,x,y)
-        yref = np.random.uniform(ymin,ymax)
-        
-        if y0>yref:
-            sample.append(x0)
-    sample = np.array(sample)
-    
-    if plot:
-        fig,ax=plt.subplots()
-        ax.hist(sample,bins=np.arange(xmin,xmax,0.01),density=True)
-        ax.plot(x,y,color='black')
-        plt.show()
-    
-    return sample
+    return sample_numerical(x,y,N=N,plot=plot)
 
 
     
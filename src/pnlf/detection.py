@@ -3,6 +3,10 @@ import inspect              # get signature of functions (e.g. to pass kwargs)
 from pathlib import Path    # filesystem related stuff
 import numpy as np          # numerical computations
 import re
+from concurrent.futures import ProcessPoolExecutor    # run pointings in parallel
+from contextlib import ExitStack                       # optional process pool
+from scipy.ndimage import find_objects                # bounding box of pointings
+from scipy.spatial import cKDTree                     # match catalogues
 
 import matplotlib.pyplot as plt
 
@@ -19,7 +23,6 @@ from photutils import DAOStarFinder            # DAOFIND routine to detect sourc
 from photutils import IRAFStarFinder           # IRAF starfind routine to detect stars
 
 from collections import OrderedDict                           # make random table reproducable
-from photutils.datasets import make_gaussian_sources_image    # create table with mock sources
 from photutils import make_source_mask, CircularAperture
 
 #from astropy.convolution import convolve, Gaussian2DKernel
@@ -36,6 +39,79 @@ logger = logging.getLogger(__name__)
 # IRAFStarFinder complains about NaN values in lt and gt
 np.warnings.filterwarnings('ignore')
 
+def label_pointings(PSF):
+    '''find the individual pointings in a PSF map
+
+    Each pointing has a different (constant) FWHM. The pointings are
+    labelled in a single pass over the image and the bounding box of
+    each pointing is computed, so that all further operations can be
+    done on small cutouts instead of the full image.
+
+    Parameters
+    ----------
+    PSF : ndarray
+        map with the FWHM of the PSF (NaN for unobserved pixels)
+
+    Returns
+    -------
+    pointings : ndarray
+        the unique FWHM of the pointings
+
+    labels : ndarray
+        map where each pixel in pointing `pointings[i]` has the value 
+        `i+1` (0 for unobserved pixels)
+
+    slices : list
+        for each pointing a tuple of slices for its bounding box
+    '''
+
+    valid = ~np.isnan(PSF)
+    pointings, inverse = np.unique(PSF[valid],return_inverse=True)
+    labels = np.zeros(PSF.shape,dtype=int)
+    labels[valid] = inverse+1
+
+    return pointings, labels, find_objects(labels)
+
+
+def _pad_slices(slices,pad,shape):
+    '''enlarge a bounding box by `pad` pixels (clipped at the border)'''
+
+    return tuple(slice(max(s.start-pad,0),min(s.stop+pad,n)) for s,n in zip(slices,shape))
+
+
+def _find_sources(data,psf_mask,exclude_region,StarFinder,fwhm,threshold,daoargs,stats=None,subtract_median=True):
+    '''run the StarFinder on a single pointing
+
+    This function is executed in the worker processes and hence must
+    be defined at the module level. `data`, `psf_mask` and 
+    `exclude_region` are usually cropped to the pointing. If `stats`
+    is None, the statistics are computed from the pixels in `psf_mask`.
+    With `subtract_median=False` the StarFinder runs on the unaltered
+    data (this is used by `completeness_limit`).
+
+    Returns
+    -------
+    peaks : Table or None
+        sources found by the StarFinder (coordinates relative to the 
+        input array)
+
+    stats : tuple
+        sigma clipped mean, median and std of the pointing
+    '''
+
+    if stats is None:
+        stats = sigma_clipped_stats(data, sigma=3.0,maxiters=5,mask=~psf_mask)
+    mean, median, std = stats
+
+    # initialize and run StarFinder (DAOPHOT or IRAF)
+    finder = StarFinder(fwhm      = fwhm, 
+                        threshold = threshold*std,
+                        **daoargs)
+    peaks = finder(data-median if subtract_median else data, mask=(~psf_mask | exclude_region))
+
+    return peaks, (mean, median, std)
+
+
 def detect_unresolved_sources(
     self : ReadLineMaps,
     line : list,
@@ -44,6 +120,7 @@ def detect_unresolved_sources(
     oversize: float=1.,
     exclude_region=None,
     save=False,
+    workers=1,
     **kwargs
     ) -> Table:
     '''detect unresolved sources in a ReadLineMaps object
@@ -68,6 +145,10 @@ def detect_unresolved_sources(
     save : bool
         save the result is to a file in `reports/catalogues/`
 
+    workers : int
+        number of processes that are used to search the pointings in 
+        parallel (each pointing is cropped to its bounding box).
+
     kwargs : dict
         other parameters are passed to StarFinder
     '''
@@ -102,41 +183,53 @@ def detect_unresolved_sources(
         PSF_correction = 0
 
     # loop over all pointings with different PSFs
-    pointings = np.unique(PSF[~np.isnan(PSF)])
+    pointings, labels, bboxes = label_pointings(PSF)
     logger.info(f'searching for sources in {len(pointings)} pointings')
     
+    # each pointing is cropped to its bounding box. The box is padded 
+    # such that the convolution kernel of the StarFinder sees the same
+    # (masked) pixels as in the full image
+    slices = []
+    tasks  = []
+    for i,(fwhm,bbox) in enumerate(zip(pointings,bboxes)):
+        slc = _pad_slices(bbox,int(np.ceil(3*fwhm*oversize)),data.shape)
+        # we create a mask for the current pointing (must be inverted)
+        psf_mask = (labels[slc] == i+1)
+        slices.append(slc)
+        tasks.append((data[slc],psf_mask,exclude_region[slc],StarFinder,
+                      (fwhm - PSF_correction) * oversize,threshold,daoargs))
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_find_sources,*zip(*tasks)))
+    else:
+        results = [_find_sources(*task) for task in tasks]
+
     # header for the print information
     logger.info(f'{"fwhm":>9}{"#N":>5}{"mean":>8}{"median":>8}{"std":>8}')
 
-    for fwhm in pointings:
-                
-        # we create a mask for the current pointing (must be inverted)
-        psf_mask = (PSF == fwhm) #& (~np.isnan(PSF))
-        #source_mask = make_source_mask(data, nsigma=2, npixels=5, dilate_size=int(3*fwhm)) | ~psf_mask
-        mean, median, std = sigma_clipped_stats(data, sigma=3.0,maxiters=5,mask=~psf_mask)
-        
-        # initialize and run StarFinder (DAOPHOT or IRAF)
-        finder = StarFinder(fwhm      = (fwhm - PSF_correction) * oversize, 
-                            threshold = threshold*std,
-                            **daoargs)
-        peaks_part = finder(data-median, mask=(~psf_mask | exclude_region))
+    peaks = []
+    for fwhm, slc, (peaks_part,(mean,median,std)) in zip(pointings,slices,results):
         
         if not peaks_part:
             logger.warning('no sources found in pointing')
             continue
         # save fwhm in an additional column
         peaks_part['fwhm'] = fwhm
-        
+        # restore the coordinates in the full image
+        peaks_part['xcentroid'] += slc[1].start
+        peaks_part['ycentroid'] += slc[0].start
+
         n_sources = len(peaks_part)
         logger.info(f'{fwhm:>7.3f}px{n_sources:>5.0f}{mean:>8.3f}{median:>8.3f}{std:>8.3f}')
         
-        # concatenate new sources with output table
-        if 'peak_tbl' in locals():
-            peaks_part['id'] += np.amax(peak_tbl['id'],initial=0)
-            peak_tbl = vstack([peak_tbl,peaks_part])
-        # if no output table exists we create a new one
-        else:
-            peak_tbl = peaks_part
+        # ids continue from the previous pointing
+        if peaks:
+            peaks_part['id'] += np.amax(peaks[-1]['id'],initial=0)
+        peaks.append(peaks_part)
+
+    # concatenate the sources from all pointings
+    peak_tbl = vstack(peaks)
 
     logger.info(f'  total{len(peak_tbl):>7.0f}')
 
@@ -163,9 +256,12 @@ def detect_unresolved_sources(
 
     return peak_tbl
 
-def match_catalogues(matchcoord,catalogcoord):
+def match_catalogues(matchcoord,catalogcoord,k=1,radius=None):
     '''match elements between two catalogues by distance
     
+    The catalogue is stored in a KD-tree, so matching N sources against
+    M catalogue entries scales like N log(M).
+
     Parameters
     ----------
     matchcoord : astropy Table
@@ -177,33 +273,134 @@ def match_catalogues(matchcoord,catalogcoord):
         Table with two columns for x and y positions in pixels. The 
         distance to the elements in this catalog are computed.
 
+    k : int
+        number of nearest neighbours that are returned. If k>1, `idx`
+        and `sep` have the shape (len(matchcoord),k). Missing neighbours
+        (if the catalogue has less than k entries) have an index of 
+        len(catalogcoord) and a separation of inf.
+
+    radius : float
+        if given, all neighbours within this radius are returned instead
+        of the k nearest ones (sorted by distance). 
+
     Returns
     -------
     idx : ndarray
         For each entry in `matchcoord`, this array contains the index of
-        the nearest neighbor in `catalogcoord`.
+        the nearest neighbor in `catalogcoord` (or an object array with 
+        the list of indices within `radius`).
 
     sep : ndarray
         For each entry in `matchcoord`, this array contains the distance
-        to the nearest neighbor in `catalogcoord`.
+        to the nearest neighbor in `catalogcoord` (or an object array
+        with the distances to all neighbours within `radius`).
     '''
         
     if len(matchcoord.columns) !=2 or  len(catalogcoord.columns)!=2:
         raise ValueError('input tables must have exactly two columns')
     
-    x_cat_name, y_cat_name = catalogcoord.columns
-    
-    idx = np.empty(len(matchcoord),dtype=int)   
-    sep = np.empty(len(matchcoord),dtype=float)
-    
-    for i, row in enumerate(matchcoord):
-        x,y = row
-        sep_i = np.sqrt((x-catalogcoord[x_cat_name])**2+(y-catalogcoord[y_cat_name])**2)
-        idx[i], sep[i] = np.argmin(sep_i), np.min(sep_i)        
+    xy_match = np.column_stack([np.asarray(matchcoord[col],dtype=float) for col in matchcoord.columns])
+    xy_cat   = np.column_stack([np.asarray(catalogcoord[col],dtype=float) for col in catalogcoord.columns])
+
+    tree = cKDTree(xy_cat)
+
+    if radius is None:
+        sep, idx = tree.query(xy_match,k=k)
+        return idx, sep
+
+    # all pairs within radius, sorted by source and then by distance
+    pairs = cKDTree(xy_match).sparse_distance_matrix(tree,radius,output_type='ndarray')
+    pairs = pairs[np.lexsort((pairs['v'],pairs['i']))]
+    splits = np.searchsorted(pairs['i'],np.arange(1,len(xy_match)))
+
+    idx = np.empty(len(matchcoord),dtype=object)
+    sep = np.empty(len(matchcoord),dtype=object)
+    for i,(idx_i,sep_i) in enumerate(zip(np.split(pairs['j'],splits),np.split(pairs['v'],splits))):
+        idx[i], sep[i] = idx_i, sep_i
         
     return idx, sep
 
 
+def render_sources(shape,x,y,flux,fwhm,model='gaussian',alpha=None,size=None,image=None):
+    '''render point sources into an image
+
+    Instead of evaluating each source on the full image, every source
+    is only rendered into a small stamp around its position. All stamps
+    are computed at once with shape (sources, stamp, stamp) and then 
+    added to the image.
+
+    Parameters
+    ----------
+    shape : tuple
+        shape of the output image (ignored if `image` is given)
+
+    x, y : ndarray
+        positions of the sources in pixel
+
+    flux : ndarray
+        total flux of each source (the sum over the rendered pixels,
+        apart from the wings outside of the stamp)
+
+    fwhm : ndarray or float
+        FWHM of each source in pixel
+
+    model : str
+        `gaussian` or `moffat`
+
+    alpha : float
+        power index of the Moffat (required if model=`moffat`)
+
+    size : int
+        half size of the stamps in pixel. Default is 3 times the largest 
+        FWHM for a Gaussian and 5 times for a Moffat.
+
+    image : ndarray
+        the sources are added to this image (in place)
+
+    Returns
+    -------
+    image : ndarray
+    '''
+
+    x    = np.atleast_1d(x).astype(float)
+    y    = np.atleast_1d(y).astype(float)
+    flux = np.atleast_1d(flux).astype(float)
+    fwhm = np.broadcast_to(fwhm,x.shape).astype(float)
+
+    if image is None:
+        image = np.zeros(shape)
+    ny, nx = image.shape
+
+    if model not in ['gaussian','moffat']:
+        raise ValueError(f'unknown model {model}')
+    if model == 'moffat' and not alpha:
+        raise ValueError('alpha is required for a moffat')
+    if len(x) == 0:
+        return image
+
+    if not size:
+        size = int(np.ceil((3 if model=='gaussian' else 5)*np.max(fwhm)))
+
+    # pixel coordinates of the stamps with shape (sources, stamp, stamp)
+    offsets = np.arange(-size,size+1)
+    xx = np.rint(x).astype(int)[:,None,None] + offsets[None,None,:]
+    yy = np.rint(y).astype(int)[:,None,None] + offsets[None,:,None]
+    r2 = (xx-x[:,None,None])**2 + (yy-y[:,None,None])**2
+
+    if model == 'gaussian':
+        sigma2 = ((fwhm*gaussian_fwhm_to_sigma)**2)[:,None,None]
+        stamps = flux[:,None,None] / (2*np.pi*sigma2) * np.exp(-r2/(2*sigma2))
+    else:
+        gamma2 = ((fwhm / (2*np.sqrt(2**(1/alpha)-1)))**2)[:,None,None]
+        stamps = flux[:,None,None] * (alpha-1)/(np.pi*gamma2) * (1+r2/gamma2)**(-alpha)
+
+    xx, yy = np.broadcast_arrays(xx,yy)
+    inside = (xx>=0) & (xx<nx) & (yy>=0) & (yy<ny)
+    np.add.at(image,(yy[inside],xx[inside]),stamps[inside])
+
+    return image
+
+
 def plot_completeness_limit(mock_sources,max_sep,limit,filename=None):
 
     hist = []
@@ -244,6 +441,174 @@ def plot_completeness_limit(mock_sources,max_sep,limit,filename=None):
         plt.savefig(filename)
     plt.show()
 
+def sample_positions(PSF,size,rng=None,valid=None):
+    '''draw random positions that are uniformly distributed in the observed area
+
+    A random pixel is chosen from all pixels with a valid (not NaN) PSF
+    and a uniform offset within this pixel is added. The positions are
+    therefore uniform in the observed area without having to reject
+    positions in unobserved regions.
+
+    Parameters
+    ----------
+    PSF : ndarray
+        map of the PSF (NaN for unobserved pixels)
+
+    size : int
+        number of positions
+
+    rng : numpy.random.Generator
+        random number generator (uses `np.random` if None)
+
+    valid : ndarray
+        flat indices of the valid pixels (computed from `PSF` if None).
+
+    Returns
+    -------
+    x : ndarray
+    y : ndarray
+    fwhm : ndarray
+        the PSF at each position
+    '''
+
+    rng = np.random.default_rng() if rng is None else rng 
+    if valid is None:
+        valid = np.flatnonzero(~np.isnan(PSF))
+    if len(valid)==0:
+        raise ValueError('PSF has no valid pixels')
+
+    idx = valid[rng.integers(0,len(valid),size=size)]
+    y, x = np.unravel_index(idx,PSF.shape)
+    fwhm = PSF.ravel()[idx]
+
+    x = x + rng.uniform(size=size)
+    y = y + rng.uniform(size=size)
+
+    return x, y, fwhm
+
+
+# state of the worker processes in `completeness_limit` (set once per
+# process by `_init_completeness_worker` to avoid sending the image with
+# every iteration)
+_completeness_context = {}
+
+def _init_completeness_worker(context):
+    _completeness_context.update(context)
+
+
+def _completeness_iteration(seed,context=None):
+    '''a single iteration of `completeness_limit`
+
+    insert mock sources into the image, search for sources in the new
+    image and match the detected sources to the inserted ones. Must be 
+    defined at the module level so it can be executed in a worker process.
+
+    Parameters
+    ----------
+    seed : numpy.random.SeedSequence
+        seed for the random number generator of this iteration
+
+    context : dict
+        image, pointings and parameters (see `completeness_limit`). Uses
+        the context of the worker process if None.
+
+    Returns
+    -------
+    mock_sources : Table or None
+        the inserted sources with the separation to the nearest detected
+        source (`sep`) and its `peak` (None if nothing was found)
+    '''
+
+    c = _completeness_context if context is None else context
+    rng = np.random.default_rng(seed)
+
+    data, PSF, labels = c['data'], c['PSF'], c['labels']
+    n_sources, tshape = c['n_sources'], data.shape
+    tile_size = c['tile_size']
+
+    mock_sources = Table(data=np.zeros((n_sources,7)),names=['magnitude','flux','x_mean','y_mean','x_stddev','y_stddev','theta'])
+    mock_sources['magnitude'] = sample_pnlf(n_sources,c['distance_modulus'],29.75,rng=rng)
+    mock_sources['flux'] = 10**(-(mock_sources['magnitude']+13.74)/2.5) *1e20
+    
+    # random positions in the observed area of the image
+    x_mean, y_mean, PSF_arr = sample_positions(PSF,n_sources,rng=rng,valid=c['valid'])
+
+    mock_sources['x_mean'], mock_sources['y_mean'] = x_mean, y_mean
+    # get PSF size at the generated position
+    mock_sources['x_stddev'] = (PSF_arr-c['PSF_correction']) * gaussian_fwhm_to_sigma * c['oversize']
+    mock_sources['y_stddev'] = mock_sources['x_stddev']
+
+    # the mock sources have the total flux of their magnitude (see the 
+    # note in `completeness_limit`)
+    mock_img = render_sources(tshape,mock_sources['x_mean'],mock_sources['y_mean'],mock_sources['flux'],
+                              (PSF_arr-c['PSF_correction']) * c['oversize'],model=c['model'],alpha=c['alpha'],
+                              image=data.copy())
+
+    #----------------------------------------------------------------
+    # detection run
+    #----------------------------------------------------------------
+    pointing = labels[mock_sources['y_mean'].astype(int),mock_sources['x_mean'].astype(int)]-1
+
+    peaks = []
+    for i,(fwhm,slc,psf_mask,stat) in enumerate(zip(c['pointings'],c['slices'],c['masks'],c['stats'])):
+        
+        pad = int(np.ceil(3*fwhm*c['oversize']))
+        if not tile_size:
+            # search the entire pointing
+            regions = [(slc,psf_mask,None)]
+        else:
+            # search only in the tiles that contain mock sources (a source
+            # close to the edge also marks the neighbouring tile because
+            # its centroid might end up there)
+            sel = pointing==i
+            xs, ys = np.array(mock_sources['x_mean'][sel]), np.array(mock_sources['y_mean'][sel])
+            tiles = np.concatenate([np.column_stack([(ys+dy)//tile_size,(xs+dx)//tile_size]) 
+                                    for dy in (-2,2) for dx in (-2,2)]).astype(int)
+            tiles = np.unique(np.clip(tiles,0,(np.array(tshape)-1)//tile_size),axis=0)
+            regions = []
+            for ty,tx in tiles:
+                core = (slice(ty*tile_size,(ty+1)*tile_size),slice(tx*tile_size,(tx+1)*tile_size))
+                region = _pad_slices(core,pad,tshape)
+                regions.append((region,labels[region]==i+1,core))
+
+            baseline = c['baseline'][i]
+            if baseline:
+                # keep the original detections outside of the searched tiles
+                tile_id = np.column_stack([baseline['ycentroid']//tile_size,baseline['xcentroid']//tile_size]).astype(int)
+                searched = np.isin(tile_id[:,0]*tshape[1]+tile_id[:,1],tiles[:,0]*tshape[1]+tiles[:,1])
+                peaks.append(baseline[~searched])
+
+        for region,region_mask,core in regions:
+            peaks_part,_ = _find_sources(mock_img[region],region_mask,c['exclude_region'][region],c['StarFinder'],
+                                         (fwhm - c['PSF_correction']) * c['oversize'],c['threshold'],c['daoargs'],
+                                         stats=stat,subtract_median=False)
+            if not peaks_part:
+                continue
+            # restore the coordinates in the full image
+            peaks_part['xcentroid'] += region[1].start
+            peaks_part['ycentroid'] += region[0].start
+            if core:
+                # sources in the padding belong to the neighbouring tiles
+                in_core = ((peaks_part['xcentroid']>=core[1].start) & (peaks_part['xcentroid']<core[1].stop) & 
+                           (peaks_part['ycentroid']>=core[0].start) & (peaks_part['ycentroid']<core[0].stop))
+                peaks_part = peaks_part[in_core]
+            peaks.append(peaks_part)
+
+    #----------------------------------------------------------------
+    # compare detected sources to known mock stars
+    #----------------------------------------------------------------
+    peaks = [p for p in peaks if len(p)>0]
+    if not peaks:
+        return None
+
+    peak_tbl = vstack(peaks)
+    idx , sep = match_catalogues(mock_sources[['x_mean','y_mean']],peak_tbl[['xcentroid','ycentroid']])
+    mock_sources['sep'] = sep
+    mock_sources['peak'] = peak_tbl[idx]['peak']
+
+    return mock_sources
+
+
 def completeness_limit(
     self,
     line,
@@ -256,6 +621,11 @@ def completeness_limit(
     exclude_region=None,
     iterations=1,
     n_sources = 500,
+    model='gaussian',
+    alpha=None,
+    tile_size=None,
+    workers=1,
+    seed=None,
     plot=False,
     **kwargs
     ): 
@@ -266,11 +636,38 @@ def completeness_limit(
     3. Compare mock sources to detected sources and determine
        the faintest sources that have been detected.
 
+    .. note::
+        The mock sources are injected with the total flux that 
+        corresponds to their magnitude. Older versions used the flux 
+        as the peak of a 1D Gaussian, so the injected total flux was
+        flux*sigma*sqrt(2pi), i.e. the sources were about 1.4 mag 
+        brighter (for sigma~1.5 px) than their magnitude. Completeness
+        limits from earlier versions are therefore about 1.4 mag too 
+        faint and must not be compared to newer ones.
+
     Parameters
     ----------
     data : ndarray
         image with
 
+    model : str
+        shape of the mock sources (`gaussian` or `moffat`)
+
+    alpha : float
+        power index of the Moffat (only for model=`moffat`)
+
+    tile_size : int
+        if given, the sources in the original image are only detected
+        once. In each iteration, the detection is repeated only in the
+        tiles (of tile_size x tile_size pixels) that contain mock sources.
+
+    workers : int
+        number of processes that run the iterations in parallel.
+
+    seed : int
+        base seed. Each iteration uses an independent random number 
+        generator derived from it, so the result is reproducible (and
+        independent of `workers`).
 
     Returns
     -------
@@ -302,116 +699,86 @@ def completeness_limit(
     except:
         PSF_correction = 0
 
-    j = 0
-    while j < iterations:
-    #for i in range(iterations):
-        
-        logger.info(f'iteration {j+1} of {iterations}')
-
-        mock_sources = Table(data=np.zeros((n_sources,7)),names=['magnitude','flux','x_mean','y_mean','x_stddev','y_stddev','theta'])
-        mock_sources['magnitude'] = sample_pnlf(n_sources,distance_modulus,29.75)
-        mock_sources['flux'] = 10**(-(mock_sources['magnitude']+13.74)/2.5) *1e20
-        
-        # create a number of random points (more than we need because
-        # some will fall in unobserved areas)
-        f = 1.5 # create more points than we need 
-        while True:
-            # number we create is f * number of sources we want / 
-            # (observed area / total area ) 
-            N = f * n_sources / (np.sum(~np.isnan(PSF)) / np.prod(self.shape))
-            indices = np.random.uniform((0,0),self.shape,(int(N),2))
-            x_mean = indices[:,1]
-            y_mean = indices[:,0]
-            PSF_arr = np.array([PSF[int(y),int(x)] for x,y in zip(x_mean,y_mean)])
-            in_frame = ~np.isnan(PSF_arr)
-
-            x_mean  = x_mean[in_frame]
-            y_mean  = y_mean[in_frame]
-            PSF_arr = PSF_arr[in_frame]
-            
-            if len(x_mean) > n_sources:
-                x_mean = x_mean[:n_sources]
-                y_mean = y_mean[:n_sources]
-                PSF_arr = PSF_arr[:n_sources]
-                break
-            else:
-                # it might happen that more points fall in unobserved
-                # areas. In this case we have to repeat
-                f *=1.1
-        
-        mock_sources['x_mean'], mock_sources['y_mean'] = x_mean, y_mean
-        # get PSF size at the generated position
-        mock_sources['x_stddev'] = (PSF_arr-PSF_correction) * gaussian_fwhm_to_sigma * oversize
-        mock_sources['y_stddev'] = mock_sources['x_stddev']
-        mock_sources['amplitude'] = mock_sources['flux'] / (mock_sources['x_stddev']*np.sqrt(2*np.pi))
-
-        logger.info(f'{len(mock_sources)} mock sources created')
-
-        if plot:
-            fig = plt.figure(figsize=(6,6))
-            ax  = fig.add_subplot(111,projection=self.wcs)
-
-            norm = simple_norm(data,'linear',clip=False,max_percent=95)
-            ax.imshow(data,norm=norm,cmap=plt.cm.Blues_r,origin='lower')
-            len(mock_sources)
-            positions = np.transpose([mock_sources['x_mean'],mock_sources['y_mean']])
-            apertures = CircularAperture(positions, r=6)
-            ax.scatter(mock_sources['x_mean'],mock_sources['y_mean'],color='tab:red')
-            #apertures.plot(color='tab:red',lw=.2, alpha=1,ax=ax)
-            plt.show()
-
-        mock_img = make_gaussian_sources_image(tshape,mock_sources)
-        mock_img += data
-
-        logger.info('mock sources inserted into image')
-        
-        #----------------------------------------------------------------
-        # detection run
-        #----------------------------------------------------------------
-        for fwhm in np.unique(PSF[~np.isnan(PSF)]):
-            # we create a mask for the current pointing (must be inverted)
-            psf_mask = (PSF == fwhm) #& (~np.isnan(PSF))
-            source_mask = make_source_mask(data, nsigma=2, npixels=5, dilate_size=int(3*fwhm)) | ~psf_mask
-            mean, median, std = sigma_clipped_stats(data, sigma=3.0,maxiters=5,mask=source_mask)
-            
-            # initialize and run StarFinder (DAOPHOT or IRAF)
-            finder = StarFinder(fwhm      = (fwhm - PSF_correction) * oversize, 
-                                threshold = threshold*std,
-                                **daoargs)
-            peaks_part = finder(mock_img, mask=(~psf_mask | exclude_region))
+    #----------------------------------------------------------------
+    # background statistics of each pointing (the same for all iterations)
+    #----------------------------------------------------------------
+    pointings, labels, bboxes = label_pointings(PSF)
 
+    slices = []
+    masks  = []
+    stats  = []
+    for i,(fwhm,bbox) in enumerate(zip(pointings,bboxes)):
+        slc = _pad_slices(bbox,int(np.ceil(3*fwhm*oversize)),data.shape)
+        # we create a mask for the current pointing (must be inverted)
+        psf_mask = (labels[slc] == i+1)
+        source_mask = make_source_mask(data[slc], nsigma=2, npixels=5, dilate_size=int(3*fwhm)) | ~psf_mask
+        slices.append(slc)
+        masks.append(psf_mask)
+        stats.append(sigma_clipped_stats(data[slc], sigma=3.0,maxiters=5,mask=source_mask))
+
+    if tile_size:
+        # detect the sources in the original image (those are reused in
+        # all tiles without mock sources)
+        baseline = []
+        for fwhm,slc,psf_mask,stat in zip(pointings,slices,masks,stats):
+            peaks_part,_ = _find_sources(data[slc],psf_mask,exclude_region[slc],StarFinder,
+                                         (fwhm - PSF_correction) * oversize,threshold,daoargs,
+                                         stats=stat,subtract_median=False)
             if peaks_part:
-                #logger.info(f'fwhm={fwhm:.3f}: {len(peaks_part)} sources found')
-                if 'peak_tbl' in locals():
-                    peaks_part['id'] += np.amax(peak_tbl['id'],initial=0)
-                    peak_tbl = vstack([peak_tbl,peaks_part])
-                else:
-                    peak_tbl = peaks_part
-            else:
-                logger.info(f'fwhm={fwhm:>7.3f}: no sources found')
-
-        if 'peak_tbl' in locals():
-            logger.info(f'{len(peak_tbl)} sources found')
-        else:
-            logger.warning('no sources found')
-            continue
-
-        #----------------------------------------------------------------
-        # compare detected sources to known mock stars
-        #----------------------------------------------------------------
-        logger.info(f'compare detected sources to injected sources')
-
-        idx , sep = match_catalogues(mock_sources[['x_mean','y_mean']],peak_tbl[['xcentroid','ycentroid']])
-        mock_sources['sep'] = sep
-        mock_sources['peak'] = peak_tbl[idx]['peak']
-        
-        if 'out' in locals():
-            out = vstack([out,mock_sources])
+                peaks_part['xcentroid'] += slc[1].start
+                peaks_part['ycentroid'] += slc[0].start
+            baseline.append(peaks_part)
+
+    context = {'data':data,'PSF':PSF,'labels':labels,'pointings':pointings,'slices':slices,
+               'masks':masks,'stats':stats,'exclude_region':exclude_region,'StarFinder':StarFinder,
+               'daoargs':daoargs,'threshold':threshold,'PSF_correction':PSF_correction,
+               'oversize':oversize,'model':model,'alpha':alpha,'tile_size':tile_size,
+               'baseline':baseline if tile_size else None,'distance_modulus':distance_modulus,
+               'n_sources':n_sources,'valid':np.flatnonzero(~np.isnan(PSF))}
+
+    # independent streams of random numbers for each iteration
+    seed_sequence = np.random.SeedSequence(seed)
+    logger.info(f'seed={seed_sequence.entropy}')
+    seeds = seed_sequence.spawn(iterations)
+
+    # the output table is allocated once and filled by the iterations
+    out = None
+    n_valid = 0
+    with ExitStack() as stack:
+        # the workers are shut down even if an iteration fails
+        if workers > 1:
+            executor = stack.enter_context(ProcessPoolExecutor(max_workers=workers,initializer=_init_completeness_worker,initargs=(context,)))
+            results = executor.map(_completeness_iteration,seeds)
         else:
-            out = mock_sources
+            results = (_completeness_iteration(s,context) for s in seeds)
 
-        del peak_tbl
-        j+= 1
+        for j,mock_sources in enumerate(results):
+            
+            # an iteration without detections says nothing about the
+            # mock sources and is not used for the completeness
+            if mock_sources is None:
+                logger.warning(f'iteration {j+1} of {iterations}: no sources found (iteration is skipped)')
+                continue
+
+            logger.info(f'iteration {j+1} of {iterations}: {np.sum(mock_sources["sep"]<max_sep)} of {n_sources} mock sources recovered')
+
+            if out is None:
+                out = Table({col: np.zeros(iterations*n_sources,dtype=mock_sources[col].dtype) for col in mock_sources.colnames})
+            out[n_valid*n_sources:(n_valid+1)*n_sources] = mock_sources
+            n_valid += 1
+
+            if plot:
+                fig = plt.figure(figsize=(6,6))
+                ax  = fig.add_subplot(111,projection=self.wcs)
+
+                norm = simple_norm(data,'linear',clip=False,max_percent=95)
+                ax.imshow(data,norm=norm,cmap=plt.cm.Blues_r,origin='lower')
+                ax.scatter(mock_sources['x_mean'],mock_sources['y_mean'],color='tab:red')
+                plt.show()
+
+    if out is None:
+        raise ValueError('no sources were found in any of the iterations')
+    out = out[:n_valid*n_sources]
 
     #----------------------------------------------------------------
     # create the histogram
@@ -0,0 +1,274 @@
+'''classify sources based on their emission lines
+
+The diagnostics operate on plain numpy arrays. The input can be anything
+that returns an array for a column name (astropy Table, structured array
+or a dict of arrays). All derived quantities are calculated once and the
+classification is stored as a compact integer code, e.g.
+
+    from pnlf.diagnostics import classify
+    codes, types, columns = classify(data,distance_modulus=29.9)
+    PN = codes == types.index('PN')
+
+A set of criteria is a dict that maps the name of a class to a function
+that takes the dict of derived columns and returns a boolean mask. The
+criteria are applied in order (later classes take precedence) and sources
+that fulfil none of them are classified as `PN`. Other criteria can be
+used without recomputing or copying the data
+
+    codes, types, columns = classify(data,29.9,criteria=hbeta_criteria)
+
+All functions work element wise and hence the columns can have any shape
+(e.g. sources x realizations).
+'''
+
+import logging              # use instead of print for more control
+import numpy as np          # numerical computations
+
+logger = logging.getLogger(__name__)
+
+# columns that must be present in the input
+required = ['HB4861','OIII5006','HA6562','NII6583','SII6716','SII6730','mOIII']
+
+# lines for which negative fluxes are replaced and the detection is checked
+lines = ['HB4861','OIII5006','HA6562','NII6583','SII']
+
+
+def _upper_limit(c):
+    '''emperical upper limit: 4 > log10 [OIII] / (Ha +[NII])'''
+    return 4 < c['R']
+
+def _HII(c):
+    '''HII regions: log10 [OIII] / (Ha +[NII]) > -0.37 M[OIII] - 1.16'''
+    return (c['R'] < -0.37*c['MOIII'] - 1.16) & (c['HA6562_detection'] | c['NII6583_detection'])
+
+def _HII_hbeta(c):
+    '''HII regions based on HB (close to OIII, so extinction is not an issue)'''
+    return (np.log10(c['OIII5006'] / c['HB4861']) < -0.37*c['MOIII'] - 0.71) & c['HB4861_detection']
+
+def _upper_limit_3sigma(c):
+    '''like `_upper_limit` but retain sources that are within 3 sigma'''
+    return 4 < c['R'] - 3*c['dR']
+
+def _HII_3sigma(c):
+    '''like `_HII` but retain sources that are within 3 sigma'''
+    return (c['R'] + 3*c['dR'] < -0.37*c['MOIII'] - 1.16) & (c['HA6562_detection'] | c['NII6583_detection'])
+
+def _SNR(c):
+    '''SNR: Ha / [SII] < 2.5 or a large velocity dispersion
+
+    the velocity dispersion is only used if the signal to noise is > 3
+    (we underestimate the error and hence S/N is too big. This justifies
+    using 3 instead of 1)
+    '''
+    return ((c['HA6562']/c['SII'] < 2.5) & c['SII_detection']) | ((c['v_SIGMA']>100) & (c['v_SIGMA_S/N']>3))
+
+
+# the criteria that are used by default (this ignores the uncertainties)
+default_criteria = {'':_upper_limit,'HII':_HII,'SNR':_SNR}
+
+# use HB instead of HA and NII to identify HII regions
+hbeta_criteria   = {'HII':_HII_hbeta,'SNR':_SNR}
+
+# sources are only removed if they are 3 sigma away from the boundary
+conservative_criteria = {'':_upper_limit_3sigma,'HII':_HII_3sigma,'SNR':_SNR}
+
+
+def column_names(data):
+    '''names of the columns in a Table, structured array or dict'''
+
+    if getattr(data,'dtype',None) is not None and data.dtype.names:
+        return list(data.dtype.names)
+    if hasattr(data,'colnames'):
+        return list(data.colnames)
+    return list(data.keys())
+
+
+def diagnostic_columns(data,distance_modulus):
+    '''calculate the quantities that are used by the criteria
+
+    The columns of the input are not modified. Only the fluxes with
+    negative values (they are set to the error) are new arrays.
+
+    Parameters
+    ----------
+    data : Table, structured array or dict
+        measured fluxes and errors (see `required`). If `HA6562_SIGMA`
+        is present it is used for the velocity dispersion.
+
+    distance_modulus : float
+       A first guess of the distance modulus (used for diagnostics)
+
+    Returns
+    -------
+    columns : dict
+        the derived quantities as numpy arrays
+    '''
+
+    c = {}
+    get = lambda name: np.asarray(data[name])
+
+    with np.errstate(divide='ignore',invalid='ignore'):
+        # calculate the absolute magnitude based on a first estimate of the distance modulus
+        c['MOIII'] = get('mOIII') - distance_modulus
+        c['SII'] = get('SII6716')+get('SII6730')
+        c['SII_err'] = np.sqrt(get('SII6716_err')**2+get('SII6730_err')**2)
+
+        # we set negative fluxes to the error (0 would cause because we work with ratios)
+        for col in lines:
+            flux = c[col] if col in c else get(col)
+            err  = c[f'{col}_err'] if col in c else get(f'{col}_err')
+            # median of error maps is a factor of 3 smaller than std of maps
+            c[f'{col}_detection'] = (flux>0) & (flux>9*err)
+            c[col] = np.where(flux<0,err,flux)
+
+        c['OIII5006_S/N'] = c['OIII5006']/get('OIII5006_err')
+        c['HA6562_S/N']   = c['HA6562']/get('HA6562_err')
+        c['SII_S/N']      = c['SII']/c['SII_err']
+
+        # use the velocity dispersion with the highest singal to noise
+        names = column_names(data)
+        c['v_SIGMA'] = get('HA6562_SIGMA') if 'HA6562_SIGMA' in names else np.full(c['MOIII'].shape,np.nan)
+        c['v_SIGMA_S/N'] = c['HA6562_S/N']
+
+        # ratio of OIII to Halpha and NII for the first criteria (with error). If NII is not detected we assume NII=0.5Halpha
+        HaNII = c['HA6562']+c['NII6583']
+        c['R']  = np.log10(c['OIII5006'] / np.where(c['NII6583_detection'],HaNII,1.5*c['HA6562']))
+        c['dR'] = np.sqrt((get('OIII5006_err') / c['OIII5006'])**2 + (get('HA6562_err') / HaNII)**2 + (get('NII6583_err') / HaNII)**2) /np.log(10)
+
+    return c
+
+
+def classify(data,distance_modulus,criteria=None,columns=None):
+    '''classify sources based on their emission lines
+
+    Parameters
+    ----------
+    data : Table, structured array or dict
+        measured fluxes and errors (see `required`)
+
+    distance_modulus : float
+       A first guess of the distance modulus (used for diagnostics)
+
+    criteria : dict
+        maps the name of each class to a function that returns a boolean
+        mask (default is `default_criteria`)
+
+    columns : dict
+        the output of `diagnostic_columns` (is computed if None)
+
+    Returns
+    -------
+    codes : ndarray
+        int8 array with the index of the class in `types`
+
+    types : list
+        name of the classes. The first is always `PN` and the last `NaN`
+        (rows with NaN values in the required columns)
+
+    columns : dict
+        the derived quantities (see `diagnostic_columns`)
+    '''
+
+    criteria = default_criteria if criteria is None else criteria
+    types = ['PN'] + [k for k in criteria if k not in ('PN','NaN')] + ['NaN']
+
+    if columns is None:
+        columns = diagnostic_columns(data,distance_modulus)
+
+    # we start with the assumption that all sources are PN and remove contaminants later
+    codes = np.zeros(columns['MOIII'].shape,dtype=np.int8)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        for k,func in criteria.items():
+            codes[func(columns)] = types.index(k)
+
+    # rows with NaN values in some columns
+    invalid = np.zeros(codes.shape,dtype=bool)
+    for col in required:
+        invalid |= np.isnan(columns.get(col,data[col]))
+    codes[invalid] = types.index('NaN')
+
+    return codes, types, columns
+
+
+def classification_probabilities(data,distance_modulus,n_draws=1000,criteria=None,seed=None,chunk_size=None):
+    '''probability of each class from random realizations of the fluxes
+
+    For each source, `n_draws` realizations of the line fluxes are drawn
+    from a normal distribution (with the `_err` columns as standard
+    deviation) and each realization is classified with `classify`. The
+    magnitude is changed consistently with the OIII flux. To limit the
+    memory usage, the sources are processed in chunks of
+    `chunk_size` x `n_draws`.
+
+    Parameters
+    ----------
+    data : Table, structured array or dict
+        measured fluxes and errors (see `required`)
+
+    distance_modulus : float
+       A first guess of the distance modulus (used for diagnostics)
+
+    n_draws : int
+        number of realizations for each source
+
+    criteria : dict
+        maps the name of each class to a function that returns a boolean
+        mask (default is `default_criteria`)
+
+    seed : int
+        seed for the random number generator. The result also depends
+        on `chunk_size`.
+
+    chunk_size : int
+        number of sources that are processed at once (default is such
+        that each array has about 10^6 elements)
+
+    Returns
+    -------
+    probabilities : ndarray
+        array with shape (sources, len(types)) with the fraction of the
+        realizations that are classified as each type
+
+    types : list
+        name of the classes (see `classify`)
+    '''
+
+    criteria = default_criteria if criteria is None else criteria
+    types = ['PN'] + [k for k in criteria if k not in ('PN','NaN')] + ['NaN']
+
+    fluxes = [col for col in required if col!='mOIII']
+    fixed  = [f'{col}_err' for col in fluxes] + [col for col in ['HA6562_SIGMA'] if col in column_names(data)]
+    columns = {col: np.asarray(data[col],dtype=float) for col in fluxes+fixed+['mOIII']}
+
+    n_sources = len(columns['mOIII'])
+    if chunk_size is None:
+        chunk_size = max(1,2**20 // n_draws)
+    chunks = range(0,n_sources,chunk_size)
+
+    seed_sequence = np.random.SeedSequence(seed)
+    logger.info(f'{n_draws} realizations for {n_sources} sources (seed={seed_sequence.entropy})')
+
+    probabilities = np.empty((n_sources,len(types)))
+    for start,child in zip(chunks,seed_sequence.spawn(len(chunks))):
+        rng = np.random.default_rng(child)
+        sl  = slice(start,start+chunk_size)
+        n   = len(columns['mOIII'][sl])
+        shape = (n,n_draws)
+
+        draws = {col: np.broadcast_to(columns[col][sl,None],shape) for col in fixed}
+        for col in fluxes:
+            draws[col] = columns[col][sl,None] + columns[f'{col}_err'][sl,None] * rng.standard_normal(shape)
+
+        # the magnitude follows the OIII flux (negative fluxes are set to the error)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            OIII = np.where(draws['OIII5006']<0,draws['OIII5006_err'],draws['OIII5006'])
+            draws['mOIII'] = columns['mOIII'][sl,None] - 2.5*np.log10(OIII/columns['OIII5006'][sl,None])
+
+        codes,_,_ = classify(draws,distance_modulus,criteria=criteria)
+
+        # count the classes of each source
+        index = codes + len(types)*np.arange(n)[:,None]
+        counts = np.bincount(index.ravel(),minlength=n*len(types))
+        probabilities[sl] = counts.reshape(n,len(types)) / n_draws
+
+    return probabilities, types
@@ -1,7 +1,9 @@
 import errno              # handle errors
 import logging            # log errors
 import os
+import hashlib            # keys for the reprojection cache
 import sys
+import tempfile           # write the reprojection cache atomically
 from pathlib import Path  # filesystem related stuff
 
 import numpy as np
@@ -36,9 +38,13 @@ class ReadLineMaps:
     Lastly it tries to open a file called `GalaxyName_seeing.fits` that 
     contains additional information about the seeing of the different 
     pointings and thus impacts the resulting point spread function (PSF).
+
+    With `lazy=True` the fits file is memory-mapped and the line maps
+    are only read from disk when the attribute is first accessed. With
+    `stacked=True` the line maps are stored in a single cube.
     '''
     
-    def __init__(self,folder,name,extensions=['HB4861','OIII5006','HA6562','NII6583','SII6716','SII6730'],**kwargs):
+    def __init__(self,folder,name,extensions=['HB4861','OIII5006','HA6562','NII6583','SII6716','SII6730'],lazy=False,cache=True,stacked=False,**kwargs):
         '''
         Parameters
         ----------
@@ -53,6 +59,19 @@ class ReadLineMaps:
             extension in the previously defined fits file (the actual name
             of the extension is `ExtensionName_FLUX` and 
             `ExtensionName_FLUX_ERR` but they are automaticly completed).
+
+        lazy : bool
+            keep the fits file open (memory-mapped) and defer reading the
+            maps until they are accessed for the first time. Use `close`
+            to release the file once all required maps are loaded.
+
+        cache : bool
+            auxiliary maps that must be reprojected are saved to disk and
+            reused in subsequent runs (see `reproject_cached`).
+
+        stacked : bool
+            store the line maps and their errors in a single cube (see
+            `stack_lines`). The maps keep their data type.
         '''
 
         # PSF is given in arcsec but we need it in pixel
@@ -88,29 +107,42 @@ class ReadLineMaps:
         #==============================================================
         # load the main DAP products
         #==============================================================
-        with fits.open(self.filename) as hdul:
-
-            # save the white-light image
-            header = hdul[f'FLUX'].header
-            setattr(self,'header',header)
-            setattr(self,'wcs',WCS(header))
-            setattr(self,'shape',(header['NAXIS2'],header['NAXIS1']))
-            setattr(self,'V_STARS',hdul['V_STARS'].data)
-            setattr(self,'stellar_mass',hdul['STELLAR_MASS_DENSITY'].data)
-            setattr(self,'stellar_mass_err',hdul['STELLAR_MASS_DENSITY_err'].data)
-            setattr(self,'Ebv_stars',hdul['EBV_STARS'].data)
-            setattr(self,'whitelight',hdul['FLUX'].data)
-            setattr(self,'whitelight_err',hdul['SNR'].data)
-
-            for line in lines:
-                # save the main data and the associated error
-                setattr(self,line,hdul[f'{line}_FLUX'].data)
-                setattr(self,f'{line}_err',hdul[f'{line}_FLUX_ERR'].data)                
-                setattr(self,f'{line}_SIGMA',np.sqrt(hdul[f'{line}_SIGMA'].data**2 - hdul[f'{line}_SIGMA_CORR'].data**2))
-                setattr(self,f'{line}_SIGMA_ERR',hdul[f'{line}_SIGMA_ERR'])
-
-                # append to list of available lines
-                self.lines.append(line)
+        hdul = fits.open(self.filename,memmap=True)
+        
+        # save the white-light image
+        header = hdul[f'FLUX'].header
+        setattr(self,'header',header)
+        setattr(self,'wcs',WCS(header))
+        setattr(self,'shape',(header['NAXIS2'],header['NAXIS1']))
+
+        # every map is described by a function that reads it from the file
+        # (the file is bound as default argument, so the loaders keep 
+        # working when the name `hdul` is reused)
+        maps = {'V_STARS' : lambda hdul=hdul: hdul['V_STARS'].data,
+                'stellar_mass' : lambda hdul=hdul: hdul['STELLAR_MASS_DENSITY'].data,
+                'stellar_mass_err' : lambda hdul=hdul: hdul['STELLAR_MASS_DENSITY_err'].data,
+                'Ebv_stars' : lambda hdul=hdul: hdul['EBV_STARS'].data,
+                'whitelight' : lambda hdul=hdul: hdul['FLUX'].data,
+                'whitelight_err' : lambda hdul=hdul: hdul['SNR'].data}
+
+        for line in lines:
+            # save the main data and the associated error
+            maps[line] = lambda line=line,hdul=hdul: hdul[f'{line}_FLUX'].data
+            maps[f'{line}_err'] = lambda line=line,hdul=hdul: hdul[f'{line}_FLUX_ERR'].data
+            maps[f'{line}_SIGMA'] = lambda line=line,hdul=hdul: np.sqrt(hdul[f'{line}_SIGMA'].data**2 - hdul[f'{line}_SIGMA_CORR'].data**2)
+            maps[f'{line}_SIGMA_ERR'] = lambda line=line,hdul=hdul: hdul[f'{line}_SIGMA_ERR'].data
+
+            # append to list of available lines
+            self.lines.append(line)
+
+        if lazy:
+            # the maps are read in `__getattr__` when they are first used
+            self._hdul = hdul
+            self._maps = maps
+        else:
+            for k,loader in maps.items():
+                setattr(self,k,loader())
+            hdul.close()
 
         #==============================================================
         # load auxiliary maps
@@ -121,10 +153,15 @@ class ReadLineMaps:
         if OIII_bkg_map_file.is_file():
             logger.info(f'replacing OIII5006 map')
             # replace the old line maps with the new one
-            setattr(self,'OIII5006_DAP',getattr(self,'OIII5006'))
-            setattr(self,'OIII5006_DAP_err',getattr(self,'OIII5006_err'))
-            data = fits.getdata(OIII_bkg_map_file,0)
-            setattr(self,'OIII5006',data)
+            if lazy:
+                self._maps['OIII5006_DAP'] = self._maps.pop('OIII5006')
+                self._maps['OIII5006_DAP_err'] = self._maps['OIII5006_err']
+                self._maps['OIII5006'] = lambda: fits.getdata(OIII_bkg_map_file,0,memmap=True)
+            else:
+                setattr(self,'OIII5006_DAP',getattr(self,'OIII5006'))
+                setattr(self,'OIII5006_DAP_err',getattr(self,'OIII5006_err'))
+                data = fits.getdata(OIII_bkg_map_file,0)
+                setattr(self,'OIII5006',data)
         else:
             logger.warn(f'"{self.name}_oiii_flux.fits" does not exists.')
 
@@ -136,12 +173,12 @@ class ReadLineMaps:
         for filename, description in zip([star_mask_file,seeing_map_file,av_file],["star_mask","PSF","Av"]):
 
             if filename.is_file():
-                with fits.open(filename) as hdul:
-                    data   = hdul[0].data
+                with fits.open(filename) as aux:
+                    data   = aux[0].data
                     
                     if self.shape != data.shape: 
                         logger.warning(f'{description} map has different shape. Reprojecting')
-                        data,_ = reproject_interp(hdul,self.header)
+                        data = reproject_cached(filename,self.header,cache=cache)
 
                         # star_mask ist 0 or 1 (even for interpolated pixels)
                         if description=='star_mask':
@@ -154,6 +191,9 @@ class ReadLineMaps:
             else:
                 logger.warning(f'no {description} available')
 
+        if stacked:
+            self.stack_lines()
+
         if not hasattr(self,'star_mask'):
             self.star_mask = np.zeros_like(self.OIII5006)
 
@@ -166,15 +206,95 @@ class ReadLineMaps:
         
         logger.info(f'file loaded with {len(self.lines)} extensions')
 
+    def __getattr__(self,name):
+        '''read a deferred map from the memory-mapped file
+        
+        this is only called if the attribute does not exist yet (which
+        is the case for maps that were not accessed since `lazy=True`).
+        '''
+
+        maps = self.__dict__.get('_maps',{})
+        if name not in maps:
+            raise AttributeError(f'{type(self).__name__} object has no attribute {name}')
+        
+        data = maps.pop(name)()
+        setattr(self,name,data)
+
+        return data
+
+    def stack_lines(self,lines=None,dtype=None):
+        '''store the line maps in a single cube
+
+        The maps of all lines are saved in `cube` and their errors in 
+        `cube_err` (both with shape (lines,ny,nx)). The order of the lines
+        is given by `cube_lines`. The individual maps (e.g. `OIII5006`) 
+        become views of the cube, so the data is only stored once.
+
+        Parameters
+        ----------
+        lines : list
+            lines that are stacked (default are all lines)
+
+        dtype : 
+            data type of the cube. The default is the data type of the 
+            maps, so the values are not changed. float32 halves the memory
+            compared to float64 but the maps (and hence all results that 
+            are derived from them) lose precision.
+
+        Returns
+        -------
+        cube : ndarray
+        '''
+
+        lines = self.lines if lines is None else lines
+        if dtype is None:
+            # the maps from the fits file are big-endian
+            dtype = np.result_type(*[getattr(self,line) for line in lines]).newbyteorder('=')
+
+        self.cube     = np.empty((len(lines),*self.shape),dtype=dtype)
+        self.cube_err = np.empty((len(lines),*self.shape),dtype=dtype)
+        for i,line in enumerate(lines):
+            self.cube[i]     = getattr(self,line)
+            self.cube_err[i] = getattr(self,f'{line}_err')
+            setattr(self,line,self.cube[i])
+            setattr(self,f'{line}_err',self.cube_err[i])
+        self.cube_lines = list(lines)
+
+        logger.info(f'stacked {len(lines)} lines ({self.cube.nbytes/2**20:.0f} MB)')
+
+        return self.cube
+
+    def close(self,load=True):
+        '''close the underlying fits file (only needed with `lazy=True`)
+        
+        maps that have not been accessed so far are read into memory
+        before the file is closed (with `load=False` they are discarded).
+        '''
+
+        if not hasattr(self,'_hdul'):
+            return 
+        
+        for name in list(self._maps):
+            if load:
+                getattr(self,name)
+            else:
+                del self._maps[name]
+        self._hdul.close()
+        del self._hdul
+
     def __repr__(self):
         '''create an overview of the available attributes'''
         
         string = ''
         for k,v in self.__dict__.items():
+            if k.startswith('_'):
+                continue
             if type(v) == str:
                 string += f'{k}: {v}\n'
             else:
                 string += k + '\n'
+        for k in self.__dict__.get('_maps',{}):
+            string += f'{k} (not loaded)\n'
                 
         return string
 
@@ -195,6 +315,69 @@ class ReadLineMaps:
         
         #return fig 
 
+def reproject_cached(filename,header,cache=True):
+    '''reproject the first extension of a fits file to a given header
+
+    The reprojection with `reproject_interp` is slow and the result is
+    the same every time the pipeline is run. The reprojected array is 
+    therefore saved in a subfolder `reprojected` next to the input file.
+    The name of the cached file contains a hash of the path, size and 
+    modification time of the input file and of the target WCS, so any
+    change to either of them triggers a new reprojection (without 
+    reading the input file on a cache hit).
+
+    Parameters
+    ----------
+    filename : Path
+        fits file with the map in the first extension
+
+    header : astropy.io.fits.Header
+        header with the target WCS and shape
+
+    cache : bool
+        read/write the reprojected array from/to the cache folder
+    
+    Returns
+    -------
+    data : ndarray
+        reprojected map
+    '''
+
+    filename = Path(filename)
+
+    stat = filename.stat()
+    sha1 = hashlib.sha1(f'{filename.resolve()}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    sha1.update(WCS(header).to_header_string().encode())
+    sha1.update(f'{header["NAXIS1"]}x{header["NAXIS2"]}'.encode())
+    cache_file = filename.parent / 'reprojected' / f'{filename.stem}_{sha1.hexdigest()[:16]}.npy'
+
+    if cache and cache_file.is_file():
+        logger.info(f'using cached reprojection "{cache_file.name}"')
+        return np.load(cache_file)
+
+    with fits.open(filename) as hdul:
+        data,_ = reproject_interp(hdul[0],header)
+
+    if cache:
+        # the array is written to a temporary file that is renamed once
+        # it is complete, so an interrupted run (or another process that
+        # writes the same file) never leaves a truncated cache file
+        tmp_file = None
+        try:
+            cache_file.parent.mkdir(exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=cache_file.parent,prefix=f'.{cache_file.stem}_',suffix='.npy',delete=False) as f:
+                tmp_file = f.name
+                np.save(f,data)
+            os.replace(tmp_file,cache_file)
+        except OSError:
+            logger.warning(f'can not write reprojection cache to {cache_file.parent}')
+        finally:
+            if tmp_file and os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    return data
+
+
 # save lines to individual .fits file
 def split_fits(filename,extensions):
     '''
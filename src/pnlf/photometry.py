@@ -1,4 +1,6 @@
 import logging              # use instead of print for more control
+from concurrent.futures import ProcessPoolExecutor    # measure pointings in parallel
+import warnings             # ignore warnings from empty samples
 from pathlib import Path    # filesystem related stuff
 import numpy as np          # numerical computations
 
@@ -9,7 +11,7 @@ import matplotlib.pyplot as plt  # plot growth curve
 import astropy.units as u        # handle units
 from astropy.coordinates import SkyCoord              # convert pixel to sky coordinates
 
-from astropy.table import vstack
+from astropy.table import Table, vstack
 
 from astropy.stats import sigma_clipped_stats  # calcualte statistics of images
 from astropy.stats import SigmaClip
@@ -25,6 +27,7 @@ from photutils import Background2D, MedianBackground, MMMBackground, SExtractorB
 from dust_extinction.parameter_averages import CCM89, F99
 
 import scipy.optimize as optimization          # fit Gaussian to growth curve
+from scipy.sparse import csr_matrix            # pixel weights of the apertures
 
 from .io import ReadLineMaps
 from .auxiliary import correct_PSF, test_convergence, \
@@ -34,7 +37,7 @@ basedir = Path(__file__).parent.parent.parent
 logger = logging.getLogger(__name__)
 
 
-def measure_flux(self,peak_tbl,alpha,Rv,Ebv,lines=None,aperture_size=1.5,background='local',extinction='MW'):
+def measure_flux(self,peak_tbl,alpha,Rv,Ebv,lines=None,aperture_size=1.5,background='local',extinction='MW',workers=1):
     '''
     measure flux for all lines in lines
     
@@ -58,6 +61,13 @@ def measure_flux(self,peak_tbl,alpha,Rv,Ebv,lines=None,aperture_size=1.5,backgro
 
     background : string
         `local` (default) or `global` or None
+
+    workers : int
+        number of processes. The pointings (and lines with different
+        apertures) are measured in parallel.
+
+    If the line maps are stacked (see `ReadLineMaps.stack_lines`), the
+    pixels are read directly from the cube.
     '''
 
     #del self.peaks_tbl['SkyCoord']
@@ -91,147 +101,95 @@ def measure_flux(self,peak_tbl,alpha,Rv,Ebv,lines=None,aperture_size=1.5,backgro
     
 
     '''
-    loop over all lines to measure the fluxes for all sources
+    prepare the line maps 
+    
+    the aperture depends on the PSF at the wavelength of the line. Lines 
+    with the same PSF correction share the same aperture and they are
+    measured together.
     '''
-    out = {}
+    shape = getattr(self,lines[0]).shape
+    groups = {}
     for line in lines:
         
-        logger.info(f'measuring fluxes in [{line}] line map')
-        
-        # select data and error (copy in case we need to modify it)
-        data  = getattr(self,f'{line}').copy()
-        error = getattr(self,f'{line}_err').copy()
-        
-        try:
-            v_disp = getattr(self,f'{line}_SIGMA')
-        except:
-            logger.warning('no maps with velocity dispersion for ' + line)
-            v_disp = np.zeros(data.shape) 
-
         # the fwhm varies slightly with wavelength
         wavelength = int(re.findall(r'\d{4}', line)[0])
-        PSF_correction = correct_PSF(wavelength)
+        groups.setdefault(correct_PSF(wavelength),[]).append(line)
+
+    # the maps are read directly from the stacked cube (if it exists)
+    # or from the individual maps (without copying them)
+    cube_lines = getattr(self,'cube_lines',[])
+    maps = {}
+    for PSF_correction,group in groups.items():
+
+        if all(line in cube_lines for line in group):
+            rows = [cube_lines.index(line) for line in group]
+            data  = (self.cube,rows)
+            error = (self.cube_err,rows)
+        else:
+            data  = ([getattr(self,f'{line}') for line in group],None)
+            error = ([getattr(self,f'{line}_err') for line in group],None)
+
+        v_disp = []
+        for line in group:
+            try:
+                v_disp.append(getattr(self,f'{line}_SIGMA'))
+            except:
+                logger.warning('no maps with velocity dispersion for ' + line)
+                v_disp.append(np.zeros(shape))
+        
+        maps[PSF_correction] = {'data': data, 'error': error, 'v_disp': (v_disp,None)}
+    stellar_mass = ([self.stellar_mass],None)
+    
+    context = {'maps':maps,'shape':shape,'alpha':alpha,'aperture_size':aperture_size,
+               'background':background,'groups':groups}
 
-        # calculate a global background map
-        mask = np.isnan(data)
-        '''
-        bkg = Background2D(data,(10,10), 
-                        #filter_size=(15,15),
-                        sigma_clip= None,#SigmaClip(sigma=3.,maxiters=None), 
-                        bkg_estimator=MedianBackground(),
-                        mask=mask).background
-        bkg[mask] = np.nan
+    '''
+    measure the individual pointings (they have different fwhm)
+    '''
+    # the sources are sorted by pointing and each pointing writes its 
+    # results in a continuous slice of the preallocated columns
+    pointings = np.unique(peak_tbl['fwhm'])
+    order = np.concatenate([np.flatnonzero(peak_tbl['fwhm']==fwhm) for fwhm in pointings])
+    x, y = np.array(peak_tbl['x'])[order], np.array(peak_tbl['y'])[order]
+    bounds = np.cumsum([0]+[np.sum(peak_tbl['fwhm']==fwhm) for fwhm in pointings])
+    
+    N = len(order)
+    columns = ['aperture_sum','aperture_sum_err','bkg_median','bkg_global','bkg_local','flux','SIGMA']
+    phot = {line : {col : np.empty(N) for col in columns} for line in lines}
+    stellar_mass_col = np.empty(N)
+
+    # one task for each pointing and group of lines 
+    tasks = []
+    for fwhm,start,stop in zip(pointings,bounds[:-1],bounds[1:]):
+        positions = np.transpose((x[start:stop],y[start:stop]))
+        for PSF_correction in groups:
+            tasks.append((fwhm,positions,PSF_correction))
+
+        # the aperture for the stellar mass is the same for all lines
+        aperture = CircularAperture(positions, r=2)
+        stellar_mass_col[start:stop] = apply_aperture_matrix(aperture_matrix(aperture,shape),*stellar_mass)[0] / aperture.area
+        
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers,initializer=_init_measure_flux_worker,initargs=(context,)) as executor:
+            results = list(executor.map(_measure_flux_task,*zip(*tasks)))
+    else:
+        results = [_measure_flux_task(*task,context=context) for task in tasks]
 
-        from astropy.convolution import convolve, Gaussian2DKernel, Box2DKernel
+    for (fwhm,positions,PSF_correction),result in zip(tasks,results):
+        start = bounds[np.flatnonzero(pointings==fwhm)[0]]
+        for j,line in enumerate(groups[PSF_correction]):
+            for col in columns:
+                phot[line][col][start:start+len(positions)] = result[col][j]
 
-        kernel = Box2DKernel(10) #Gaussian2DKernel(10) 
-        bkg_convolve = convolve(data,kernel,nan_treatment='interpolate',preserve_nan=True)
+    out = {}
+    for line in lines:
+        # the id continues across the pointings
+        flux = Table({'id':np.arange(1,N+1),'xcenter':x,'ycenter':y})
+        for col in columns:
+            flux[col] = phot[line][col]
+        flux['stellar_mass'] = stellar_mass_col
+        flux['fwhm'] = np.array(peak_tbl['fwhm'])[order]
 
-    
-        # this is too slow and the masks ignore bright HA emitter etc.
-        source_mask = np.zeros(self.shape,dtype=bool)
-
-        for fwhm in np.unique(peak_tbl['fwhm']):
-            source_part = peak_tbl[peak_tbl['fwhm']==fwhm]
-            positions = np.transpose((source_part['x'], source_part['y']))
-            r = 4 * (fwhm-PSF_correction) / 2 
-            aperture = CircularAperture(positions, r=r)
-            for m in aperture.to_mask(method='center'):
-                source_mask |= m.to_image(self.shape).astype(bool)
-        '''
-
-        '''
-        loop over the individual pointings (they have different fwhm)
-        '''
-        for fwhm in np.unique(peak_tbl['fwhm']):
-
-            source_part = peak_tbl[peak_tbl['fwhm']==fwhm]
-            positions = np.transpose((source_part['x'], source_part['y']))
-
-            gamma = (fwhm - PSF_correction) / (2*np.sqrt(2**(1/alpha)-1))
-
-            if aperture_size > 3:
-                logger.warning('aperture > 3 FWHM')
-            r = aperture_size * (fwhm-PSF_correction) / 2 
-            aperture = CircularAperture(positions, r=r)
-
-            # measure the flux for each source
-            phot = aperture_photometry(data, aperture, error = error)
-
-            # calculate background in this aperture (from global map)
-            phot['bkg_global'] = 0 #aperture_photometry(bkg, aperture)['aperture_sum']
-            #phot['bkg_convolve'] = aperture_photometry(bkg_convolve, aperture)['aperture_sum']
-
-
-            # the local background subtraction estimates the background for 
-            # each source individually (annulus with 5 times the area of aperture) 
-            r_in  = 4 * (fwhm-PSF_correction) / 2 
-            r_out = np.sqrt(5*r**2+r_in**2)
-            annulus_aperture = CircularAnnulus(positions, r_in=r_in, r_out=r_out)
-            annulus_masks = annulus_aperture.to_mask(method='center')
-
-            # background from annulus with sigma clipping
-            bkg_median = []
-            bkg_median_no_clip = []
-            for mask in annulus_masks:
-                # select the pixels inside the annulus and calulate sigma clipped median
-                annulus_data = mask.multiply(data)
-                annulus_data_1d = annulus_data[mask.data > 0]
-                median_sigclip,_ , _ = sigma_clipped_stats(annulus_data_1d[~np.isnan(annulus_data_1d)],sigma=3,maxiters=3)          
-                bkg_median_no_clip.append(np.nanmedian(annulus_data_1d[~np.isnan(annulus_data_1d)]))          
-
-                bkg_median.append(median_sigclip)
-            # save bkg_median in case we need it again
-            phot['bkg_median'] = np.array(bkg_median) 
-            phot['bkg_global'] = np.array(bkg_median_no_clip)*aperture.area
-            # multiply background with size of the aperture
-            phot['bkg_local'] = phot['bkg_median'] * aperture.area
-            
-            '''
-            # background from annulus with masked sources
-            ones = np.ones(self.shape)
-            # calculate flux in annulus where other sources are masked
-            bkg_phot = aperture_photometry(data,annulus_aperture,mask=source_mask)
-            # calculate area of the annulus (parts can be masked)
-            bkg_area = aperture_photometry(ones,annulus_aperture,mask=source_mask)
-            # save bkg_median in case we need it again
-            phot['bkg_median'] = bkg_phot['aperture_sum'] / bkg_area['aperture_sum'] 
-            # multiply background with size of the aperture
-            phot['bkg_local'] = phot['bkg_median'] * aperture.area
-            '''
-
-            # we don't subtract the background from OIII because there is none
-            if line == 'OIII5006_DAP':
-                phot['flux'] = phot['aperture_sum']
-            else:
-                if background == 'local':
-                    phot['flux'] = phot['aperture_sum'] - phot['bkg_local']
-                else:
-                    phot['flux'] = phot['aperture_sum'] - phot['bkg_global']
-
-            # calculate the average of the velocity dispersion
-            aperture = CircularAperture(positions, r=4)
-            SIGMA = aperture_photometry(v_disp,aperture)
-            phot['SIGMA'] = SIGMA['aperture_sum'] / aperture.area
-
-            aperture = CircularAperture(positions, r=2)
-            stellar_mass = aperture_photometry(self.stellar_mass,aperture)
-            phot['stellar_mass'] = stellar_mass['aperture_sum'] / aperture.area
-
-            # correct for flux that is lost outside of the aperture
-            phot['flux'] /= light_in_moffat(r,alpha,gamma)
-            #phot['flux'] /= light_in_gaussian(r,fwhm)
-            
-            # save fwhm in an additional column
-            phot['fwhm'] = fwhm
-            
-            # concatenate new sources with output table
-            if 'flux' in locals():
-                phot['id'] += np.amax(flux['id'],initial=0)
-                flux = vstack([flux,phot])
-            else:
-                flux = phot
-            
         # for consistent table output
         for col in flux.colnames:
             flux[col].info.format = '%.8g'  
@@ -239,12 +197,8 @@ def measure_flux(self,peak_tbl,alpha,Rv,Ebv,lines=None,aperture_size=1.5,backgro
    
         out[line] = flux
         
-        # we need an empty table for the next line
-        del flux
-
-    # initialize extinction model
-    extinction_model = CCM89(Rv=Rv)
-    #k = lambda lam: ext_model.evaluate(lam*u.angstrom,Rv) * Rv
+    # we need an empty table for the extinction correction
+    del flux
 
     # so far we have an individual table for each emission line
     for k,v in out.items():
@@ -256,51 +210,368 @@ def measure_flux(self,peak_tbl,alpha,Rv,Ebv,lines=None,aperture_size=1.5,backgro
             flux.rename_column('ycenter','y')
             flux['x'] = flux['x'].value         # we don't want them to be in pixel units
             flux['y'] = flux['y'].value
+
+            # pixel of each source (to read the values from the maps)
+            x, y = flux['x'].astype(int), flux['y'].astype(int)
             if hasattr(self,'Av'):
                 # if the galaxy has an associated Av map we can correct for internal extinction
-                flux['Av']  = 0.44 * np.array([self.Av[int(row['y']),int(row['x'])] for row in flux])
+                flux['Av']  = 0.44 * self.Av[y,x]
             else:
                 flux['Av'] = 0
             if hasattr(self,'Ebv'):
-                flux['Ebv'] = np.array([self.Ebv_stars[int(row['y']),int(row['x'])] for row in flux])
+                flux['Ebv'] = self.Ebv_stars[y,x]
             else:
                 flux['Ebv'] = 0
 
         flux[k] = v['flux'] 
-        
-        # linemaps are already MW extinction corrected (OIII sum is not) 
+        flux[f'{k}_aperture_sum'] = v['aperture_sum']
+        flux[f'{k}_err'] = v['aperture_sum_err']
+        flux[f'{k}_bkg_local']  = v['bkg_local']
+        flux[f'{k}_bkg_global'] = v['bkg_global']
+        flux[f'{k}_bkg_median'] = v['bkg_median']
+        #flux[f'{k}_bkg_convole'] = v['bkg_convolve']
+        flux[f'{k}_SIGMA'] = v['SIGMA']
+
+    extinction_correction(flux,lines,Rv,Ebv,extinction=extinction)
+
+    logger.info('all flux measurements completed')
+
+    return flux
+
+# maps of the worker processes in `measure_flux` (set once per process
+# by `_init_measure_flux_worker`)
+_measure_flux_context = {}
+
+def _init_measure_flux_worker(context):
+    _measure_flux_context.update(context)
+
+
+def _measure_flux_task(fwhm,positions,PSF_correction,context=None):
+    '''measure the fluxes of one group of lines in one pointing
+
+    This function is used by `measure_flux` and must be defined at the
+    module level so it can be executed in a worker process.
+
+    Parameters
+    ----------
+    fwhm : float
+        fwhm of the pointing
+
+    positions : ndarray
+        (x,y) of the sources in this pointing
+
+    PSF_correction : float
+        PSF correction of the group of lines (key in `context['groups']`)
+
+    context : dict
+        maps and parameters (see `measure_flux`). Uses the context of 
+        the worker process if None.
+
+    Returns
+    -------
+    dict
+        one array with shape (lines,sources) for each column 
+    '''
+
+    c = _measure_flux_context if context is None else context
+    m, shape, alpha = c['maps'][PSF_correction], c['shape'], c['alpha']
+    group = c['groups'][PSF_correction]
+
+    logger.info(f'measuring fluxes in {group} line map(s) for fwhm={fwhm:.2f}')
+    
+    gamma = (fwhm - PSF_correction) / (2*np.sqrt(2**(1/alpha)-1))
+
+    if c['aperture_size'] > 3:
+        logger.warning('aperture > 3 FWHM')
+    r = c['aperture_size'] * (fwhm-PSF_correction) / 2 
+    aperture = CircularAperture(positions, r=r)
+
+    # measure the flux for each source (one row for each line)
+    W = aperture_matrix(aperture,shape)
+    result = {'aperture_sum' : apply_aperture_matrix(W,*m['data']),
+              'aperture_sum_err' : np.sqrt(apply_aperture_matrix(W,*m['error'],power=2))}
+
+    # the local background subtraction estimates the background for 
+    # each source individually (annulus with 5 times the area of aperture) 
+    r_in  = 4 * (fwhm-PSF_correction) / 2 
+    r_out = np.sqrt(5*r**2+r_in**2)
+    annulus_aperture = CircularAnnulus(positions, r_in=r_in, r_out=r_out)
+    annulus_matrix = aperture_matrix(annulus_aperture,shape,method='center')
+
+    # the pixels of each annulus in a padded array (sources,pixels)
+    n_pixels = np.diff(annulus_matrix.indptr)
+    annulus_valid = np.arange(np.amax(n_pixels,initial=0)) < n_pixels[:,None]
+    annulus_index = np.zeros(annulus_valid.shape,dtype=int)
+    annulus_index[annulus_valid] = annulus_matrix.indices
+
+    # background from annulus with sigma clipping (all sources and
+    # lines at once). The array has the shape (lines,sources,pixels).
+    # Pixels outside of the image are not part of the annulus (they 
+    # used to be included as zeros, which lowered the background of 
+    # sources close to the edge)
+    annulus_data = gather_pixels(*m['data'],annulus_index)
+    annulus_data[:,~annulus_valid] = np.nan
+    bkg_median,_,_ = batch_sigma_clipped_stats(annulus_data,sigma=3,maxiters=3)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore',RuntimeWarning)
+        bkg_median_no_clip = np.nanmedian(annulus_data,axis=-1)
+
+    # save bkg_median in case we need it again
+    result['bkg_median'] = bkg_median 
+    result['bkg_global'] = bkg_median_no_clip*aperture.area
+    # multiply background with size of the aperture
+    result['bkg_local'] = bkg_median * aperture.area
+
+    flux = np.empty_like(result['aperture_sum'])
+    for j,line in enumerate(group):
+        # we don't subtract the background from OIII because there is none
+        if line == 'OIII5006_DAP':
+            flux[j] = result['aperture_sum'][j]
+        else:
+            if c['background'] == 'local':
+                flux[j] = result['aperture_sum'][j] - result['bkg_local'][j]
+            else:
+                flux[j] = result['aperture_sum'][j] - result['bkg_global'][j]
+
+    # correct for flux that is lost outside of the aperture
+    result['flux'] = flux / light_in_moffat(r,alpha,gamma)
+    #result['flux'] = flux / light_in_gaussian(r,fwhm)
+
+    # calculate the average of the velocity dispersion
+    aperture = CircularAperture(positions, r=4)
+    result['SIGMA'] = apply_aperture_matrix(aperture_matrix(aperture,shape),*m['v_disp']) / aperture.area
+    
+    return result
+
+
+def extinction_correction(flux,lines,Rv,Ebv,extinction='MW'):
+    '''correct the measured fluxes for extinction (in place)
+
+    The extinction curve (CCM89) is evaluated once for each line and 
+    applied to all sources at once. The line maps are already corrected
+    for Milky Way extinction, only the OIII5006 flux (from the cubes) is
+    corrected here.
+
+    Parameters
+    ----------
+    flux : Table
+        Table with the fluxes of the lines (e.g. from `measure_flux`). For
+        the internal extinction, a column `Av` is required.
+
+    lines : list
+        lines that are corrected (the name must contain the wavelength as
+        4 digit number in angstrom)
+
+    Rv : float
+        Rv of the extinction curve
+
+    Ebv : float
+        E(B-V) of the Milky Way extinction
+
+    extinction : str
+        `MW` (default) or `all` (Milky Way and internal extinction)
+
+    Returns
+    -------
+    flux : Table
+    '''
+
+    # initialize extinction model
+    extinction_model = CCM89(Rv=Rv)
+
+    for k in lines:
+
         wavelength = re.findall(r'\d{4}', k)
         if len(wavelength) != 1:
             logger.error('line name must contain wavelength as 4 digit number in angstrom')
         wavelength = int(wavelength[0])
-        extinction_mw = extinction_model.extinguish(wavelength*u.angstrom,Ebv=Ebv)
 
+        # A(lambda)/A(V) is the same for all sources
+        k_lambda = extinction_model(wavelength*u.angstrom)
+
+        # linemaps are already MW extinction corrected (OIII sum is not) 
         if k=='OIII5006':
+            extinction_mw = 10**(-0.4*k_lambda*Rv*Ebv)
             flux[k] /= extinction_mw
             logger.info(f'lambda{wavelength}: Av={-2.5*np.log10(extinction_mw):.2f}')
  
-        #extinction_int = extinction_model.extinguish(wavelength*u.angstrom,Av=flux['Av'])
-        extinction_int = extinction_model.extinguish(wavelength*u.angstrom,Av=flux['Av'])
-
         if extinction == 'all':
-            flux[k][~np.isnan(extinction_int)] /= extinction_int[~np.isnan(extinction_int)]
+            extinction_int = 10**(-0.4*k_lambda*np.asarray(flux['Av']))
+            valid = ~np.isnan(extinction_int)
+            flux[k][valid] /= extinction_int[valid]
 
-        flux[f'{k}_aperture_sum'] = v['aperture_sum']
-        flux[f'{k}_err'] = v['aperture_sum_err']
-        flux[f'{k}_bkg_local']  = v['bkg_local']
-        flux[f'{k}_bkg_global'] = v['bkg_global']
-        flux[f'{k}_bkg_median'] = v['bkg_median']
-        #flux[f'{k}_bkg_convole'] = v['bkg_convolve']
-        flux[f'{k}_SIGMA'] = v['SIGMA']
+    return flux
 
-    logger.info('all flux measurements completed')
 
-    return flux
+def aperture_matrix(aperture,shape,method='exact'):
+    '''sparse matrix with the pixel weights of the apertures
+
+    Row i contains the weights of aperture i for the pixels of the 
+    flattened image. The sum in all apertures is therefore given by
+    `W @ data.ravel()` (and for multiple images of the same shape
+    `W @ np.column_stack([d.ravel() for d in images])`). Pixels outside
+    of the image are ignored.
+
+    Parameters
+    ----------
+    aperture : photutils.Aperture
+        the apertures (e.g. `CircularAperture` or `CircularAnnulus`)
+
+    shape : tuple
+        shape of the image
+
+    method : str
+        passed to `aperture.to_mask` (`exact`, `center` or `subpixel`)
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        matrix with shape (number of apertures, number of pixels)
+    '''
+
+    masks = aperture.to_mask(method=method)
+    if not isinstance(masks,list):
+        masks = [masks]
+
+    # apertures with the same size share the same template of pixel 
+    # offsets within the bounding box
+    templates = {}
+    for i,mask in enumerate(masks):
+        templates.setdefault(mask.data.shape,[]).append(i)
+
+    rows, cols, weights = [], [], []
+    for template,idx in templates.items():
+        data = np.stack([masks[i].data for i in idx])
+        dy, dx = np.indices(template)
+        y = np.array([masks[i].bbox.iymin for i in idx])[:,None,None] + dy
+        x = np.array([masks[i].bbox.ixmin for i in idx])[:,None,None] + dx
+        inside = (data>0) & (y>=0) & (y<shape[0]) & (x>=0) & (x<shape[1])
+        rows.append(np.broadcast_to(np.array(idx)[:,None,None],data.shape)[inside])
+        cols.append(np.ravel_multi_index((y[inside],x[inside]),shape))
+        weights.append(data[inside])
+
+    if not masks:
+        return csr_matrix((0,np.prod(shape)))
+
+    return csr_matrix((np.concatenate(weights),(np.concatenate(rows),np.concatenate(cols))),
+                      shape=(len(masks),np.prod(shape)))
+
+
+def batch_sigma_clipped_stats(data,sigma=3,maxiters=3):
+    '''sigma clipped statistics along the last axis
+
+    Same as `astropy.stats.sigma_clipped_stats` but for many samples at 
+    once (e.g. the pixels in the annuli of all sources). Samples of 
+    different size are padded with NaN.
+
+    Parameters
+    ----------
+    data : ndarray
+        the samples are along the last axis. NaN values are ignored
+
+    sigma : float
+        number of standard deviations for the clipping
+
+    maxiters : int
+        maximum number of clipping iterations (None to clip until no 
+        more values are rejected)
+
+    Returns
+    -------
+    mean, median, std : ndarray
+        the sigma clipped statistics of each sample (NaN if a sample has
+        no valid values)
+    '''
+
+    data = np.array(data,dtype=float)
+
+    with warnings.catch_warnings():
+        # samples without valid values are NaN
+        warnings.simplefilter('ignore',RuntimeWarning)
+
+        i = 0
+        while maxiters is None or i < maxiters:
+            i += 1
+            median = np.nanmedian(data,axis=-1,keepdims=True)
+            std    = np.nanstd(data,axis=-1,keepdims=True)
+            clip = (data < median-sigma*std) | (data > median+sigma*std) 
+            # each sample stops when no values are clipped
+            if not np.any(clip):
+                break
+            data[clip] = np.nan
+
+        return np.nanmean(data,axis=-1), np.nanmedian(data,axis=-1), np.nanstd(data,axis=-1)
+
+
+def gather_pixels(maps,rows,index):
+    '''read the values of multiple maps at the given pixels
+
+    Parameters
+    ----------
+    maps : ndarray or list
+        either a cube with shape (n,ny,nx) or a list of 2D maps
+
+    rows : list
+        the maps in the cube that are used (use None for a list of maps)
+
+    index : ndarray
+        index of the pixels in the flattened maps (any shape)
+
+    Returns
+    -------
+    ndarray
+        array with shape (number of maps,*index.shape)
+    '''
+
+    if rows is not None:
+        # only the requested pixels are read from the cube
+        flat = maps.reshape(maps.shape[0],-1)
+        rows = np.reshape(rows,(-1,)+(1,)*np.ndim(index))
+        return flat[rows,index]
+    
+    return np.stack([np.ravel(m)[index] for m in maps])
+
+
+def apply_aperture_matrix(W,maps,rows=None,power=1):
+    '''sum the (weighted) pixels in each aperture for multiple maps
+
+    Same as `W @ m.ravel()**power` for each map m but the maps are not 
+    copied (only the pixels in the apertures are read).
+
+    Parameters
+    ----------
+    W : scipy.sparse.csr_matrix
+        pixel weights from `aperture_matrix`
+
+    maps, rows : 
+        see `gather_pixels`
+
+    power : float
+        the pixel values are raised to this power (e.g. 2 to sum the 
+        variance from the error maps)
+
+    Returns
+    -------
+    ndarray
+        array with shape (number of maps,number of apertures)
+    '''
+
+    values = gather_pixels(maps,rows,W.indices)**power * W.data
+    
+    # reduceat requires the start of each non empty aperture
+    n_pixels = np.diff(W.indptr)
+    sums = np.zeros((values.shape[0],W.shape[0]),dtype=values.dtype)
+    if np.any(n_pixels):
+        sums[:,n_pixels>0] = np.add.reduceat(values,W.indptr[:-1][n_pixels>0],axis=1)
+
+    return sums
+
 
 def measure_single_flux(img,positions,aperture_size,model='Moffat',alpha=None,gamma=None,fwhm=None,bkg=True,plot=False):
     '''Measure the flux for a single object
     
-    The Background is subtracted from an annulus. No error is reported
+    The Background is subtracted from an annulus. No error is reported.
+    Use `batch_measure_single_flux` for many objects.
 
     Parameters
     ----------
@@ -324,24 +595,102 @@ def measure_single_flux(img,positions,aperture_size,model='Moffat',alpha=None,ga
         determines if the background is subtracted
     '''
 
+    phot = batch_measure_single_flux(img,*positions,aperture_size,model=model,
+                                     alpha=alpha,gamma=gamma,fwhm=fwhm,bkg=bkg)
+    
+    if plot:
+        from astropy.visualization import simple_norm
+
+        r, r_in, r_out = phot['r'][0], phot['r_in'][0], phot['r_out'][0]
+        norm = simple_norm(img, 'sqrt', percent=99)
+        plt.imshow(img, norm=norm)
+        CircularAperture(positions, r=r).plot(color='orange', lw=2)
+        CircularAnnulus(positions, r_in=r_in, r_out=r_out).plot(color='red', lw=2)
+        plt.show()
+
+    #return phot
+    return phot['flux'][0]
+
+
+def batch_measure_single_flux(img,x,y,aperture_size,model='Moffat',alpha=None,gamma=None,fwhm=None,bkg=True):
+    '''Measure the flux for many objects in the same image
+    
+    Same as `measure_single_flux` but for arrays of positions (and 
+    optionally different PSF parameters for each source). Sources with
+    the same aperture share the same aperture and annulus masks.
+
+    Parameters
+    ----------
+
+    img : ndarray
+        array with the image data
+
+    x, y : ndarray
+        positions of the sources
+
+    aperture_size : float
+        aperture size in units of FWHM
+    
+    alpha : float or ndarray
+        power index of the Moffat
+    
+    gamma : float or ndarray
+        other parameter for the Moffat
+
+    fwhm : float or ndarray
+        fwhm of the Gaussian
+
+    bkg : bool
+        determines if the background is subtracted. The background is the
+        sigma clipped median in an annulus (with a single clipping 
+        iteration, unlike `measure_flux`).
+
+    Returns
+    -------
+    Table
+        the flux of each source (and the aperture sums, background and
+        radii that were used)
+    '''
+
+    x, y = np.atleast_1d(x).astype(float), np.atleast_1d(y).astype(float)
+
     if model=='Moffat':
+        alpha, gamma = np.broadcast_to(alpha,x.shape).astype(float), np.broadcast_to(gamma,x.shape).astype(float)
         fwhm = 2 * gamma * np.sqrt(2**(1/alpha)-1)
+    elif model=='Gaussian':
+        fwhm = np.broadcast_to(fwhm,x.shape).astype(float)
+    else:
+        raise ValueError(f'unkown model {model}')
     
     r = aperture_size * (fwhm) / 2 
-    aperture = CircularAperture(positions, r=r)
-    phot = aperture_photometry(img,aperture)
-
     r_in  = 4 * fwhm / 2 
     r_out = np.sqrt(3*r**2+r_in**2)
-    annulus_aperture = CircularAnnulus(positions, r_in=r_in, r_out=r_out)
-    mask = annulus_aperture.to_mask(method='center')
-
-    annulus_data = mask.multiply(img)
-    annulus_data_1d = annulus_data[mask.data > 0]
-    _, median_sigclip, _ = sigma_clipped_stats(annulus_data_1d[~np.isnan(annulus_data_1d)],sigma=3,maxiters=1)          
 
-    phot['bkg_median'] = np.array(median_sigclip) 
-    phot['bkg_local'] = phot['bkg_median'] * aperture.area
+    phot = Table({'id':np.arange(1,len(x)+1),'xcenter':x,'ycenter':y,
+                  'r':r,'r_in':r_in,'r_out':r_out})
+    phot['aperture_sum'] = np.nan
+    phot['bkg_median'] = np.nan
+
+    # the masks are created once for all sources with the same radius
+    radii, group = np.unique(np.column_stack([r,r_in,r_out]),axis=0,return_inverse=True)
+    for i,(r_i,r_in_i,r_out_i) in enumerate(radii):
+        sel = np.flatnonzero(group.ravel()==i)
+        positions = np.transpose((x[sel],y[sel]))
+
+        W = aperture_matrix(CircularAperture(positions, r=r_i),img.shape)
+        phot['aperture_sum'][sel] = apply_aperture_matrix(W,[img])[0]
+
+        A = aperture_matrix(CircularAnnulus(positions, r_in=r_in_i, r_out=r_out_i),img.shape,method='center')
+        n_pixels = np.diff(A.indptr)
+        valid = np.arange(np.amax(n_pixels,initial=0)) < n_pixels[:,None]
+        annulus_index = np.zeros(valid.shape,dtype=int)
+        annulus_index[valid] = A.indices
+        annulus_data = np.where(valid,np.ravel(img)[annulus_index],np.nan)
+        # a single clipping iteration like the original `measure_single_flux`
+        # (`measure_flux` uses 3), so the fluxes are the same as before
+        _, phot['bkg_median'][sel], _ = batch_sigma_clipped_stats(annulus_data,sigma=3,maxiters=1)
+
+    phot['bkg_local'] = phot['bkg_median'] * np.pi*r**2
     if bkg:
         phot['flux'] = phot['aperture_sum'] - phot['bkg_local']
     else:
@@ -349,23 +698,11 @@ def measure_single_flux(img,positions,aperture_size,model='Moffat',alpha=None,ga
 
     if model=='Moffat':
         correction = light_in_moffat(r,alpha,gamma)
-    elif model=='Gaussian':
-        correction = light_in_gaussian(r,fwhm)
     else:
-        raise ValueError(f'unkown model {model}')
+        correction = light_in_gaussian(r,fwhm)
     phot['flux'] /= correction
     
-    if plot:
-        from astropy.visualization import simple_norm
-
-        norm = simple_norm(img, 'sqrt', percent=99)
-        plt.imshow(img, norm=norm)
-        aperture.plot(color='orange', lw=2)
-        annulus_aperture.plot(color='red', lw=2)
-        plt.show()
-
-    #return phot
-    return phot['flux'][0]
+    return phot
 
 
 from astropy.modeling.models import custom_model
@@ -379,122 +716,221 @@ def _moffat_model(x,alpha=2.5,gamma=3.0):
 def _gaussian_model(x,fwhm=2):
     return light_in_gaussian(x,fwhm)
 
-def growth_curve(data,x,y,model,rmax=30,alpha=None,plot=False,**kwargs):
-    '''do a growth curve analysis on the given star
-    
-    measure the amount of light as a function of radius and tries
-    to fit a Gaussian to the measured profile. Returns the FWHM
-    of the Gaussian.
+def _growth_curve_jacobian(radius,params,model):
+    '''model and derivatives for the fit in `growth_curves`'''
+
+    r2 = radius[None,:]**2
+    if model == 'gaussian':
+        fwhm = params[:,0,None]
+        e = np.exp(-4*np.log(2)*r2 / fwhm**2)
+        return 1-e, (-e*8*np.log(2)*r2/fwhm**3)[...,None]
+    else:
+        alpha, gamma = params[:,0,None], params[:,1,None]
+        u = 1+r2/gamma**2
+        d_alpha = u**(1-alpha) * np.log(u)
+        d_gamma = (1-alpha) * u**(-alpha) * 2*r2/gamma**3
+        return 1-u**(1-alpha), np.stack([d_alpha,d_gamma],axis=-1)
+
+
+def _fit_growth_curves(radius,flux,model,guess,fixed=None,maxiter=200,tol=1e-10):
+    '''fit the growth curves of many stars at once (Levenberg-Marquardt)
+
+    Parameters
+    ----------
+    radius : ndarray
+        radii (the same for all stars)
+
+    flux : ndarray
+        normalized growth curves with shape (stars,radii)
+
+    model : str
+        `gaussian` or `moffat`
+
+    guess : ndarray
+        initial parameters with shape (stars,parameters)
+
+    fixed : ndarray
+        boolean array with the parameters that are not fitted
+    '''
+
+    params = np.array(guess,dtype=float)
+    free = np.ones(params.shape[1],dtype=bool) if fixed is None else ~np.asarray(fixed)
+    damping = np.full(len(params),1e-3)
+
+    model_flux,J = _growth_curve_jacobian(radius,params,model)
+    chi2 = np.sum((flux-model_flux)**2,axis=1)
+    active = np.isfinite(chi2)
+    for i in range(maxiter):
+        if not np.any(active):
+            break
+
+        res = flux[active]-model_flux[active]
+        Jf  = J[active][...,free]
+        JTJ = np.einsum('nmi,nmj->nij',Jf,Jf)
+        JTr = np.einsum('nmi,nm->ni',Jf,res)
+        A = JTJ + damping[active,None,None] * JTJ * np.eye(len(JTJ[0]))
+        try:
+            step = np.linalg.solve(A,JTr[...,None])[...,0]
+        except np.linalg.LinAlgError:
+            step = np.stack([np.linalg.lstsq(a,b,rcond=None)[0] for a,b in zip(A,JTr)])
+
+        new = params[active].copy()
+        new[:,free] += step
+        new_flux,new_J = _growth_curve_jacobian(radius,new,model)
+        new_chi2 = np.sum((flux[active]-new_flux)**2,axis=1)
+        
+        # accept the steps that improve the fit and adjust the damping
+        better = new_chi2 < chi2[active]
+        idx = np.flatnonzero(active)
+        converged = np.abs(chi2[idx]-np.where(better,new_chi2,chi2[idx])) <= tol*np.maximum(chi2[idx],tol)
+        params[idx[better]] = new[better]
+        model_flux[idx[better]] = new_flux[better]
+        J[idx[better]] = new_J[better]
+        chi2[idx[better]] = new_chi2[better]
+        damping[idx] = np.where(better,damping[idx]/10,damping[idx]*10)
+
+        active[idx[(better & converged) | (damping[idx]>1e10)]] = False
+
+    return params
+
+
+def growth_curves(data,x,y,model,rmax=30,alpha=None):
+    '''growth curve analysis for many stars at once
+
+    For each star, a stamp with the distance of each pixel to the
+    position of the star is created. The pixels are sorted by distance
+    and the light within each radius (0.5 to rmax in steps of 0.5 pixel)
+    is given by the cumulative sum of the background subtracted pixels
+    (pixels are included if their center lies within the radius). The 
+    background is the sigma clipped median in an annulus between 
+    0.7*rmax and rmax. The normalized growth curves of all stars are 
+    then fitted simultaneously with a Gaussian or Moffat profile.
 
     Parameters
     ----------
+    data : ndarray
+        image with the stars
+
+    x, y : ndarray
+        positions of the stars
 
     model : str
         shape of the PSF. Must be either `gaussian` or `moffat`.
     
     rmax : float
         maximum radius for the growth curve
+
+    alpha : float
+        fix the power index of the Moffat to this value
+
+    Returns
+    -------
+    Table
+        the fitted parameters (`fwhm` and for the Moffat `alpha` and 
+        `gamma`) and the growth curves (`radius` and `flux`). Stars with 
+        NaN in the background or the growth curve have `fwhm=inf`.
     '''
-    
+
+    if model not in ['gaussian','moffat']:
+        raise TypeError('model must be `moffat` or `gaussian`')
+
+    x, y = np.atleast_1d(x).astype(float), np.atleast_1d(y).astype(float)
+    radius = np.arange(0.5,rmax+0.25,0.5)
+
+    # stamps around each star (pixels outside of the image are NaN)
+    size = int(np.ceil(rmax))+1
+    offset = np.arange(-size,size+1)
+    iy = np.round(y).astype(int)[:,None,None] + offset[None,:,None]
+    ix = np.round(x).astype(int)[:,None,None] + offset[None,None,:]
+    inside = (iy>=0) & (iy<data.shape[0]) & (ix>=0) & (ix<data.shape[1])
+    stamps = np.where(inside,data[np.clip(iy,0,data.shape[0]-1),np.clip(ix,0,data.shape[1]-1)],np.nan)
+    distance = np.sqrt((ix-x[:,None,None])**2+(iy-y[:,None,None])**2)
+    stamps, distance = stamps.reshape(len(x),-1), distance.reshape(len(x),-1)
+
     # -----------------------------------------------------------------
     # determine background (we use same bkg_median for all apertures)
     # -----------------------------------------------------------------
+    annulus = np.where((distance>=0.7*rmax) & (distance<rmax),stamps,np.nan)
+    _, bkg_median, _ = batch_sigma_clipped_stats(annulus,maxiters=None)
 
-    r_in  = 0.7*rmax
-    r_out = rmax
-    annulus_aperture = CircularAnnulus((x,y), r_in=r_in, r_out=r_out)
-    mask = annulus_aperture.to_mask(method='center')
-    annulus_data = mask.multiply(data)
-    annulus_data_1d = annulus_data[mask.data > 0]
-    _, bkg_median, _ = sigma_clipped_stats(annulus_data_1d[~np.isnan(annulus_data_1d)],maxiters=None)
-
-    if np.isnan(bkg_median):
-        logger.warning('background contains NaN')
-        if model == 'moffat':
-            return np.array([np.inf,np.inf]), np.atleast_1d(np.inf)
-        else:
-            return np.array([np.inf]), np.atleast_1d(np.inf)        
+    # -----------------------------------------------------------------
+    # measure flux for all radii (cumulative sum of the sorted pixels)
+    # -----------------------------------------------------------------
+    order = np.argsort(distance,axis=1)
+    distance = np.take_along_axis(distance,order,axis=1)
+    cumsum = np.zeros((len(x),distance.shape[1]+1))
+    cumsum[:,1:] = np.cumsum(np.take_along_axis(stamps,order,axis=1),axis=1)
+
+    # number of pixels within each radius (the rows are shifted such that
+    # a single searchsorted can be used for all stars)
+    shift = 2*(size+1)*np.arange(len(x))[:,None]
+    n_pixels = np.searchsorted((distance+shift).ravel(),(radius[None,:]+shift).ravel()).reshape(len(x),-1)
+    n_pixels -= distance.shape[1]*np.arange(len(x))[:,None]
+
+    # the background is subtracted from the same pixels that are summed
+    flux = np.take_along_axis(cumsum,n_pixels,axis=1) - n_pixels*bkg_median[:,None]
+    with np.errstate(invalid='ignore',divide='ignore'):
+        flux = flux/flux[:,-1,None]
+    
+    valid = np.isfinite(bkg_median) & np.all(np.isfinite(flux),axis=1)
+    if np.any(~valid):
+        logger.warning(f'{np.sum(~valid)} growth curve(s) contain NaN')
 
     # -----------------------------------------------------------------
-    # measure flux for different aperture radii
+    # fit moffat or gaussian
     # -----------------------------------------------------------------
+    tbl = Table({'x':x,'y':y})
+    if model == 'moffat':
+        guess = np.tile([alpha if alpha else 2.5,3.0],(len(x),1))
+        fixed = [bool(alpha),False]
+        fit = np.full(guess.shape,np.inf)
+        fit[valid] = _fit_growth_curves(radius,flux[valid],model,guess[valid],fixed)
+        tbl['alpha'], tbl['gamma'] = fit[:,0], fit[:,1]
+        tbl['fwhm'] = 2*tbl['gamma'] * np.sqrt(2**(1/tbl['alpha'])-1)
+    else:
+        fit = np.full((len(x),1),np.inf)
+        fit[valid] = _fit_growth_curves(radius,flux[valid],model,np.full((np.sum(valid),1),2.))
+        tbl['fwhm'] = fit[:,0]
 
-    radius = []
-    flux   = []
+    tbl['radius'] = np.tile(radius,(len(x),1))
+    tbl['flux'] = flux
 
-    r = 0.5
-    while True:
-        if r > rmax:
-            logger.debug(f'no convergence within a radius of {rmax:.2f}')
-            break
+    return tbl
 
-        aperture = CircularAperture((x,y), r=r)
-        phot = aperture_photometry(data,aperture)
-        flux.append(phot['aperture_sum'][0]-aperture.area*bkg_median)
-        radius.append(r)
 
-        #if test_convergence(flux,**kwargs):
-        #    pass
-        #    break
-        
-        r += 0.5
+def growth_curve(data,x,y,model,rmax=30,alpha=None,plot=False,**kwargs):
+    '''do a growth curve analysis on the given star
+    
+    measure the amount of light as a function of radius and tries
+    to fit a Gaussian to the measured profile. Returns the FWHM
+    of the Gaussian. Use `growth_curves` for many stars.
 
-    radius = np.array(radius)
-    flux = np.array(flux)   
-    flux = flux/flux[-1]
+    Parameters
+    ----------
+
+    model : str
+        shape of the PSF. Must be either `gaussian` or `moffat`.
+    
+    rmax : float
+        maximum radius for the growth curve
+    '''
+    
+    tbl = growth_curves(data,x,y,model,rmax=rmax,alpha=alpha)[0]
+    radius, flux = tbl['radius'], tbl['flux']
 
-    if np.any(np.isnan(flux)):
+    if not np.isfinite(tbl['fwhm']):
         if model == 'moffat':
             return np.array([np.inf,np.inf]), np.atleast_1d(np.inf)
         else:
-            return np.array([np.inf]), np.atleast_1d(np.inf)
-
-    # -----------------------------------------------------------------
-    # fit moffat or gaussian
-    # -----------------------------------------------------------------
+            return np.array([np.inf]), np.atleast_1d(np.inf)        
 
     if model == 'moffat':
-        '''
-        guess = np.array([2,2])
-        func = light_in_moffat
-        fit,sig = optimization.curve_fit(func, radius,flux , guess)
-        alpha, gamma = fit[0], fit[1]
-        fwhm = 2*gamma * np.sqrt(2**(1/alpha)-1)
-        #print(f'alpha={alpha:.2f}, gamma={gamma:.2f}, fwhm={fwhm:.2f}')
-        '''
         func = light_in_moffat
-
-        if alpha:
-            model = _moffat_model(alpha=alpha)
-            model.alpha.fixed=True
-        else:
-            model = _moffat_model()
-
-        fitter = fitting.LevMarLSQFitter() 
-        fitted_line = fitter(model, radius,flux)
-        alpha,gamma = fitted_line.parameters
-        fit = [alpha,gamma]
-        fwhm = 2*gamma * np.sqrt(2**(1/alpha)-1)
-        print(f'alpha={alpha:.2f}, gamma={gamma:.2f}, fwhm={fwhm:.2f}')
-
-    elif model == 'gaussian':
-        '''
-        guess =5
-        func = light_in_gaussian
-        fit,sig = optimization.curve_fit(func, radius,flux , guess)
-        fwhm = fit[0]
-        '''
-        func = light_in_gaussian
-
-        model = _gaussian_model()
-        fitter = fitting.LevMarLSQFitter() 
-        fitted_line = fitter(model, radius,flux)
-        fwhm = fitted_line.parameters
-        fit = [fwhm]    
+        fit = [tbl['alpha'],tbl['gamma']]
     else:
-        raise TypeError('model must be `moffat` or `gaussian`')
+        func = light_in_gaussian
+        fit = [np.atleast_1d(tbl['fwhm'])]
 
-    
     if plot:
         from astropy.visualization import simple_norm
 
@@ -516,6 +952,3 @@ def growth_curve(data,x,y,model,rmax=30,alpha=None,plot=False,**kwargs):
         plt.grid()
 
     return fit
-
-
-
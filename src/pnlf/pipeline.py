@@ -0,0 +1,315 @@
+'''run the full PNLF analysis for many galaxies
+
+The steps are the same as in the production notebook and the old
+production script (read the data, detect sources, measure fluxes, 
+emission line diagnostics, fit the PNLF and plot the result, see 
+`run_galaxy`). Each galaxy is processed in its own worker process so a
+full survey scales with the number of available cores.
+
+from the command line (with the package installed)
+
+    pnlf-pipeline parameters.yml path/to/MUSEDAP --workers 8
+
+or from python
+
+    from pnlf.pipeline import read_parameters, run_pipeline
+    results = run_pipeline(read_parameters(filename),data_folder,workers=8)
+'''
+
+import logging              # use instead of print for more control
+import argparse             # command line interface
+import json                 # read parameter files
+import time                 # report the runtime of each galaxy
+from pathlib import Path    # filesystem related stuff
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np          # numerical computations
+import yaml
+
+from astropy.io import ascii
+from astropy.table import Table
+from astropy.coordinates import SkyCoord
+
+basedir = Path(__file__).parent.parent.parent
+logger = logging.getLogger(__name__)
+
+lines = ['HB4861','OIII5006','HA6562','NII6583','SII6716','SII6730']
+
+
+def read_parameters(filename):
+    '''read the parameters of all galaxies from a `.yml` or `.json` file'''
+
+    filename = Path(filename)
+    with open(filename) as f:
+        if filename.suffix in ['.yml','.yaml']:
+            parameters = yaml.load(f,Loader=yaml.FullLoader)
+        elif filename.suffix == '.json':
+            parameters = json.load(f)
+        else:
+            raise ValueError(f'unknown file format {filename.suffix}')
+
+    return parameters
+
+
+def run_galaxy(name,parameters,data_folder,output=None,Rv=3.1,aperture_size=2.5,extinction='MW'):
+    '''run the full pipeline for a single galaxy
+
+    The steps are the same as in the production notebook:
+
+    1. read the line maps
+    2. detect sources in the OIII map
+    3. measure the fluxes. The Milky Way extinction is corrected with 
+       `Ebv` (if a galaxy has no `Ebv`, Av=0.2 is used like in the old
+       production script). HA6562, NII6583 and SII6716 fluxes that are
+       negative or have S/N<3 are replaced by their error (upper limits).
+    4. emission line diagnostics
+    5. fit the PNLF to the PN that are detected in OIII, brighter than
+       the completeness limit and pass the sharpness and roundness cuts.
+       The uncertainties are multiplied by 1.67 (the errors are 
+       underestimated, see `estimate_uncertainties_from_SII`) and the
+       uncertainty of the PSF (`dPSF`) is added in quadrature.
+
+    The PNs that are excluded by hand in the notebook (`exclude` and
+    `overluminous`) are not removed here.
+
+    All log messages of the package that are emitted while this galaxy
+    is processed are written to `reports/{name}/{name}.log`.
+
+    Parameters
+    ----------
+    name : str
+        name of the galaxy (must be a key in `parameters`)
+
+    parameters : dict
+        parameters of this galaxy. Must contain `mu`, `power_index` and
+        `completeness_limit`. Optional are `threshold` (8), `Ebv`,
+        `dPSF` (0.153), `sharplo` (0.2), `sharphi` (1) and `roundness`
+        (0.8). All entries are passed on to `ReadLineMaps`.
+
+    data_folder : Path
+        folder with the MUSEDAP files (see `ReadLineMaps`)
+
+    output : Path
+        folder for the reports (default is `basedir/reports`)
+
+    extinction : str
+        `MW` or `all` (see `photometry.extinction_correction`)
+
+    Returns
+    -------
+    result : dict
+        the fitted distance modulus and some information about the run
+    '''
+
+    # the imports are done here such that each worker process only
+    # loads them once it actually has some work to do
+    import matplotlib
+    matplotlib.use('agg')
+    import matplotlib.pyplot as plt
+    from photutils import DAOStarFinder
+
+    from .io import ReadLineMaps
+    from .detection import detect_unresolved_sources
+    from .photometry import measure_flux
+    from .analyse import emission_line_diagnostics, MaximumLikelihood1D, pnlf_convolved
+    from .plot.pnlf import plot_pnlf
+
+    output = Path(output) if output else basedir / 'reports'
+    (output / name).mkdir(parents=True,exist_ok=True)
+
+    # log everything from this package to a separate file
+    handler = logging.FileHandler(output / name / f'{name}.log',mode='w')
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s',datefmt='%H:%M:%S'))
+    package = logging.getLogger(__name__.split('.')[0])
+    level = package.level
+    package.addHandler(handler)
+    package.setLevel(logging.INFO)
+
+    start = time.time()
+    galaxy = None
+    try:
+        '''
+        Step 1: Read in the data
+        '''
+        galaxy = ReadLineMaps(Path(data_folder),name,extensions=lines,lazy=True,**parameters)
+
+        '''
+        Step 2: Detect sources
+        '''
+        # use the line map from the DAP if the OIII map was replaced
+        line = 'OIII5006_DAP' if hasattr(galaxy,'OIII5006_DAP') else 'OIII5006'
+        sources = detect_unresolved_sources(galaxy,
+                                            line,
+                                            StarFinder=DAOStarFinder,
+                                            threshold=getattr(galaxy,'threshold',8.),
+                                            exclude_region=galaxy.star_mask.astype(bool),
+                                            save=False)
+
+        # the rows of `measure_flux` are sorted by pointing
+        sources = sources[np.argsort(sources['fwhm'],kind='stable')]
+
+        '''
+        Step 3: Measure fluxes
+        '''
+        flux = measure_flux(galaxy,
+                            sources,
+                            alpha=galaxy.power_index,
+                            Rv=Rv,
+                            Ebv=getattr(galaxy,'Ebv',0.2/Rv),
+                            extinction=extinction,
+                            background='local',
+                            aperture_size=aperture_size)
+
+        # lines that are not detected are replaced by upper limits
+        for col in ['HA6562','NII6583','SII6716']:
+            flux[col][flux[col]<0] = flux[f'{col}_err'][flux[col]<0]
+            flux[col][flux[col]/flux[f'{col}_err']<3] = flux[f'{col}_err'][flux[col]/flux[f'{col}_err']<3]
+
+        # calculate magnitudes from measured fluxes
+        flux['mOIII'] = -2.5*np.log10(flux['OIII5006']*1e-20) - 13.74
+        flux['dmOIII'] = np.abs( 2.5/np.log(10) * flux['OIII5006_err'] / flux['OIII5006'] )
+        flux['SkyCoord'] = SkyCoord.from_pixel(flux['x'],flux['y'],galaxy.wcs)
+
+        '''
+        Step 4: Emission line diagnostics
+        '''
+        tbl = emission_line_diagnostics(flux,galaxy.mu,galaxy.completeness_limit)
+
+        filename = output / name / f'{name}_pn_candidates.txt'
+        with open(filename,'w',newline='\n') as f:
+            tbl['RaDec'] = tbl['SkyCoord'].to_string(style='hmsdms',precision=2)
+            for col in tbl.colnames:
+                if col not in ['id','RaDec','type']:
+                    tbl[col].info.format = '%.3f'
+            ascii.write(tbl[['id','type','x','y','RaDec','OIII5006','OIII5006_err','mOIII','dmOIII','HA6562','HA6562_err',
+                                'NII6583','NII6583_err','SII6716','SII6716_err']][tbl['type']!='NaN'],
+                        f,format='fixed_width',delimiter='\t',overwrite=True)
+
+        '''
+        Step 5: Fit with maximum likelihood
+        '''
+        # sharpness and roundness cuts (only for finders that provide them)
+        c_shape = np.ones(len(tbl),dtype=bool)
+        if 'sharpness' in sources.colnames and 'roundness2' in sources.colnames:
+            tbl['sharp'] = sources['sharpness']
+            tbl['round'] = sources['roundness2']
+            c_shape = (tbl['sharp']>getattr(galaxy,'sharplo',0.2)) & (tbl['sharp']<getattr(galaxy,'sharphi',1.)) & \
+                      (np.abs(tbl['round'])<getattr(galaxy,'roundness',0.8))
+
+        # we underestimate the errors (see `estimate_uncertainties_from_SII`)
+        tbl['dmOIII'] *= 1.67
+        tbl['dmOIII'] = np.sqrt(tbl['dmOIII']**2 + getattr(galaxy,'dPSF',0.153)**2)
+
+        criteria = c_shape & (tbl['type']=='PN') & tbl['OIII5006_detection'] & (tbl['mOIII']<galaxy.completeness_limit)
+        data = np.array(tbl[criteria]['mOIII'])
+        err  = np.array(tbl[criteria]['dmOIII'])
+
+        # the analytic convolution with the errors (see `pnlf_convolved`)
+        fitter = MaximumLikelihood1D(pnlf_convolved,data,mhigh=galaxy.completeness_limit,dm=err)
+        mu,mu_p,mu_m = fitter([galaxy.mu])
+
+        filename = output / name / f'{name}_PNLF'
+        plot_pnlf(tbl[c_shape & (tbl['type']=='PN')]['mOIII'],mu,galaxy.completeness_limit,binsize=0.25,mhigh=30,filename=filename)
+        plt.close('all')
+
+        logger.info(f'{name}: {mu:.2f}+{mu_p:.2f}-{mu_m:.2f} (literature {galaxy.mu:.2f})')
+    finally:
+        # release the memory-mapped file (the remaining maps are not needed)
+        if galaxy is not None:
+            galaxy.close(load=False)
+        package.removeHandler(handler)
+        package.setLevel(level)
+        handler.close()
+
+    return {'name':name,'mu':mu,'mu_plus':mu_p,'mu_minus':mu_m,
+            'N_PN':len(data),'runtime':time.time()-start}
+
+
+def run_pipeline(parameters,data_folder,names=None,workers=None,**kwargs):
+    '''run the pipeline for many galaxies in parallel
+
+    Galaxies that fail are reported in the log and omitted from the
+    result table (the remaining galaxies are still processed).
+
+    Parameters
+    ----------
+    parameters : dict
+        dict with one entry per galaxy (see `run_galaxy`)
+
+    data_folder : Path
+        folder with the MUSEDAP files
+
+    names : list
+        only process those galaxies (default is all in `parameters`)
+
+    workers : int
+        number of worker processes. Uses all cores if None. With
+        `workers=1` the galaxies are processed in the current process.
+
+    kwargs : dict
+        other parameters are passed to `run_galaxy`
+
+    Returns
+    -------
+    Table
+        one row with the fitted distance modulus for each galaxy
+    '''
+
+    names = list(parameters.keys()) if names is None else names
+    logger.info(f'running pipeline for {len(names)} galaxies')
+
+    results = []
+    if workers == 1:
+        for name in names:
+            try:
+                results.append(run_galaxy(name,parameters[name],data_folder,**kwargs))
+            except Exception:
+                logger.exception(f'{name} failed')
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(run_galaxy,name,parameters[name],data_folder,**kwargs) : name for name in names}
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    results.append(future.result())
+                except Exception:
+                    logger.exception(f'{name} failed')
+                    continue
+                logger.info(f'{name} finished in {results[-1]["runtime"]:.0f}s')
+
+    table = Table(rows=[list(r.values()) for r in results],names=['name','mu','mu_plus','mu_minus','N_PN','runtime'])
+    table.sort('name')
+    for col in ['mu','mu_plus','mu_minus']:
+        table[col].info.format = '%.3f'
+    table['runtime'].info.format = '%.1f'
+
+    logger.info(f'{len(table)} of {len(names)} galaxies completed')
+
+    return table
+
+
+def main(args=None):
+    '''command line interface for `run_pipeline`'''
+
+    parser = argparse.ArgumentParser(description='run the PNLF pipeline for multiple galaxies')
+    parser.add_argument('parameters',help='.yml or .json file with the parameters for each galaxy')
+    parser.add_argument('data_folder',help='folder with the MUSEDAP files')
+    parser.add_argument('--names',nargs='+',default=None,help='only process those galaxies')
+    parser.add_argument('--workers',type=int,default=None,help='number of worker processes')
+    parser.add_argument('--output',default=None,help='folder for the reports')
+    args = parser.parse_args(args)
+
+    logging.basicConfig(datefmt='%H:%M:%S',level=logging.INFO)
+
+    parameters = read_parameters(args.parameters)
+    results = run_pipeline(parameters,Path(args.data_folder),names=args.names,
+                           workers=args.workers,output=args.output)
+
+    output = Path(args.output) if args.output else basedir / 'reports'
+    with open(output / 'distances.txt','w',newline='\n') as f:
+        ascii.write(results,f,format='fixed_width_two_line',overwrite=True)
+    results.pprint(max_lines=-1)
+
+
+if __name__ == '__main__':
+    main()
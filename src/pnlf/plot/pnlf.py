@@ -40,11 +40,11 @@ def _plot_pnlf(data,mu,completeness,mask=None,binsize=0.4,mlow=None,mhigh=None,M
         mhigh = completeness+2
 
     bins = np.arange(mlow,mhigh,binsize)
-    hist, bins  = np.histogram(data[~mask],bins,normed=False)
+    hist, bins  = np.histogram(data[~mask],bins,density=False)
 
     # we need to extend the bins
     bins_OL = np.arange(mlow-binsize*np.ceil((mlow-np.min(data))/binsize),mhigh,binsize)
-    hist_OL, _  = np.histogram(data[mask],bins_OL,normed=False)
+    hist_OL, _  = np.histogram(data[mask],bins_OL,density=False)
     m_OL = (bins_OL[1:]+bins_OL[:-1]) / 2
 
     err = np.sqrt(hist)
@@ -55,7 +55,7 @@ def _plot_pnlf(data,mu,completeness,mask=None,binsize=0.4,mlow=None,mhigh=None,M
     binsize_fine = 0.1
     bins_fine = np.arange(mlow-binsize_fine,mhigh+binsize_fine,binsize_fine)
     m_fine = (bins_fine[1:]+bins_fine[:-1]) /2
-    #hist_fine, _ = np.histogram(data[~mask],bins_fine,normed=False)
+    #hist_fine, _ = np.histogram(data[~mask],bins_fine,density=False)
 
     if not ax:
         # create an empty figure
@@ -113,7 +113,7 @@ def _plot_cum_pnlf(data,mu,completeness=None,binsize=None,mlow=None,mhigh=None,M
     if not mhigh:
         mhigh = completeness+2
     
-    hist, bins  = np.histogram(data,np.arange(mlow,mhigh,binsize),normed=False)
+    hist, bins  = np.histogram(data,np.arange(mlow,mhigh,binsize),density=False)
     err = np.sqrt(hist)
     # midpoint of the bins is used as position for the plots
     m = (bins[1:]+bins[:-1]) / 2
@@ -122,7 +122,7 @@ def _plot_cum_pnlf(data,mu,completeness=None,binsize=None,mlow=None,mhigh=None,M
     binsize_fine = 0.05
     bins_fine = np.arange(mlow,mhigh,binsize_fine)
     m_fine = (bins_fine[1:]+bins_fine[:-1]) /2
-    hist_fine, _ = np.histogram(data,bins_fine,normed=False)
+    hist_fine, _ = np.histogram(data,bins_fine,density=False)
 
     if not ax:
         # create an empty figure
@@ -0,0 +1,177 @@
+'''draw random samples from the PNLF (and other distributions)
+
+The PNLF has an analytic integral `F` and its inverse is found with a
+vectorized Newton method (safeguarded by bisection), starting from a
+cached table of `F`. The result is exact (to numerical precision), e.g.
+
+    from pnlf.sampling import sample_pnlf
+    m = sample_pnlf(10**7,mu=29.9,cl=28)
+
+For distributions that are only given numerically, `sample_numerical`
+uses a vectorized rejection sampler.
+'''
+
+import logging              # use instead of print for more control
+from functools import lru_cache
+import numpy as np          # numerical computations
+
+import matplotlib.pyplot as plt
+
+from .analyse import f, F
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=32)
+def _cdf_table(mu,mhigh,Mmax,size=4097):
+    '''tabulated integral of the PNLF (cached for each mu and mhigh)
+
+    The grid is denser at the bright end where the PNLF goes to zero.
+    '''
+
+    t = np.linspace(0,1,size)
+    m = mu+Mmax + (mhigh-mu-Mmax)*t**2
+
+    return F(m,mu,Mmax=Mmax), m
+
+
+def inverse_cdf(u,mu,mhigh,Mmax=-4.47,tol=1e-10,maxiter=50):
+    '''inverse of the cumulative distribution function of the PNLF
+
+    Solves cdf(m) = u for m (see `analyse.cdf`). The starting point is
+    interpolated from a tabulated (and cached) `F` and then refined with
+    Newton steps. Steps that leave the current bracket are replaced by
+    bisection (the derivative vanishes at the bright end).
+
+    Parameters
+    ----------
+    u : ndarray
+        values between 0 and 1
+
+    mu : float
+        distance modulus
+
+    mhigh : float
+        completeness level
+
+    Mmax : float
+        Magnitude of the brightest PN.
+
+    Returns
+    -------
+    m : ndarray
+        apparent magnitudes with the same shape as u
+    '''
+
+    u = np.asarray(u,dtype=float)
+    if np.any((u<0) | (u>1)):
+        raise ValueError('u must be between 0 and 1')
+
+    mlow = mu+Mmax
+    Flow = F(mlow,mu,Mmax=Mmax)
+    target = (Flow + u*(F(mhigh,mu,Mmax=Mmax)-Flow)).ravel()
+
+    F_table, m_table = _cdf_table(float(mu),float(mhigh),float(Mmax))
+    m = np.interp(target,F_table,m_table)
+
+    # bracket of the solution (F is monotonic)
+    idx = np.clip(np.searchsorted(F_table,target),1,len(F_table)-1)
+    lo, hi = m_table[idx-1], m_table[idx]
+
+    # only the elements that have not converged are updated
+    active = np.arange(len(m))
+    with np.errstate(divide='ignore',invalid='ignore'):
+        for i in range(maxiter):
+            x = m[active]
+            residual = F(x,mu,Mmax=Mmax) - target[active]
+            lo[active] = np.where(residual<0,x,lo[active])
+            hi[active] = np.where(residual>0,x,hi[active])
+
+            # exact solutions are kept (f vanishes at the bright cutoff)
+            new = np.where(residual==0,x,x - residual / f(x,mu,Mmax=Mmax))
+            bisect = ~np.isfinite(new) | (new<lo[active]) | (new>hi[active])
+            new[bisect] = (lo[active][bisect]+hi[active][bisect])/2
+
+            m[active] = new
+            active = active[np.abs(new-x) >= tol]
+            if len(active) == 0:
+                break
+        else:
+            logger.warning(f'inverse_cdf did not converge for {len(active)} values')
+
+    return m.reshape(u.shape)
+
+
+def sample_pnlf(size,mu,cl,Mmax=-4.47,rng=None):
+    '''draw random magnitudes from the PNLF
+
+    Parameters
+    ----------
+    size : int or tuple
+        number of samples
+
+    mu : float
+        distance modulus
+
+    cl : float
+        completeness limit (the faintest magnitude)
+
+    rng : numpy.random.Generator
+        random number generator (the global numpy state is used if None)
+    '''
+
+    u = (np.random if rng is None else rng).uniform(size=size)
+
+    return inverse_cdf(u,mu,cl,Mmax=Mmax)
+
+
+def sample_numerical(x,y,N=100,rng=None,plot=False):
+    '''sample from a PDF given by two arrays
+
+    The samples are drawn with rejection sampling. The candidates are
+    drawn in batches (the size is estimated from the acceptance rate),
+    so only a few iterations are needed.
+
+    Parameters
+    ----------
+    x : ndarray
+        monotonically increasing values
+
+    y : ndarray
+        (unnormalized) PDF at x
+
+    N : int
+        number of samples
+
+    rng : numpy.random.Generator
+        random number generator (the global numpy state is used if None)
+    '''
+
+    rng = np.random if rng is None else rng
+    x, y = np.asarray(x,dtype=float), np.asarray(y,dtype=float)
+
+    xmin,xmax = np.min(x),np.max(x)
+    ymax = np.max(y)
+    if ymax <= 0:
+        raise ValueError('y must have positive values')
+
+    # expected fraction of accepted candidates
+    rate = np.trapz(y,x) / ((xmax-xmin)*ymax)
+
+    samples = []
+    n = 0
+    while n < N:
+        size = int(1.1*(N-n)/rate)+10
+        x0 = rng.uniform(xmin,xmax,size)
+        accept = np.interp(x0,x,y) > rng.uniform(0,ymax,size)
+        samples.append(x0[accept])
+        n += np.sum(accept)
+    sample = np.concatenate(samples)[:N]
+
+    if plot:
+        fig,ax=plt.subplots()
+        ax.hist(sample,bins=np.arange(xmin,xmax,0.01),density=True)
+        ax.plot(x,y,color='black')
+        plt.show()
+
+    return sample
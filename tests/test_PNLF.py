@@ -1,7 +1,11 @@
-from pnlf.analyse import f,F
+from pnlf.analyse import f,F,pnlf,pnlf_convolved,gaussian,JointMaximumLikelihood,MaximumLikelihood1D
+from pnlf.sampling import sample_pnlf
 
+import math
 import numpy as np
+import pytest
 from scipy.integrate import quad
+from scipy.optimize import approx_fprime
 
 
 def test_integral():
@@ -9,4 +13,118 @@ def test_integral():
     m = np.arange(25.1,27,0.25)
     integral = np.array([quad(f,25,b,args=(29))[0] for b in m])
 
-    np.testing.assert_almost_equal(F(m,29)-F(25,29),integral)
\ No newline at end of file
+    np.testing.assert_almost_equal(F(m,29)-F(25,29),integral)
+
+
+def test_convolved():
+
+    mu, mhigh = 29, 27.5
+    m  = np.array([24.6,25.,26.,27.,27.6])
+    dm = np.array([0.05,0.1,0.2,0.3,0.1])
+    integral = np.array([quad(lambda x: pnlf(x,mu,mhigh)[0]*gaussian(x,a,b),mu-4.47,mhigh,points=[a])[0] for a,b in zip(m,dm)])
+
+    np.testing.assert_allclose(pnlf_convolved(m,mu,mhigh,dm),integral,rtol=1e-6)
+
+
+def test_joint_gradient():
+
+    rng = np.random.default_rng(1)
+    mu, mhigh = np.array([29.,30.,31.]), np.array([27.,28.,28.5])
+    data = [sample_pnlf(50,m,h,rng=rng) for m,h in zip(mu,mhigh)]
+    dm = [np.full(len(d),0.1) for d in data]
+
+    for err in [None,dm]:
+        fitter = JointMaximumLikelihood(data,mhigh,dm=err,mu_prior=[29,np.nan,np.nan],mu_prior_err=[0.1,np.nan,np.nan])
+        params = np.append(mu-0.05,-4.5)
+        value, grad = fitter.likelihood(params)
+        numerical = approx_fprime(params,lambda x: fitter.likelihood(x)[0],1e-7)
+        np.testing.assert_allclose(grad,numerical,rtol=1e-4,atol=1e-3)
+
+
+def test_evidence_grid():
+
+    data = np.array([0.1,-0.5,0.3,1.2])
+    params = np.linspace(-1,1,5)
+
+    # functions that do not broadcast are evaluated for each parameter
+    scalar = lambda x,mu: np.array([math.exp(-(a-mu)**2/2) for a in x])
+    fitter = MaximumLikelihood1D(scalar,data,prior=lambda mu: math.exp(-mu**2))
+    np.testing.assert_allclose(fitter.evidence_grid(params),[fitter.evidence(p) for p in params])
+    np.testing.assert_allclose(fitter.prior_grid(params),np.exp(-params**2))
+
+    # other errors in `func` are not hidden
+    def broken(x,mu):
+        raise KeyError('mu')
+    with pytest.raises(KeyError):
+        MaximumLikelihood1D(broken,data).evidence_grid(params)
+
+
+def test_bootstrap():
+
+    rng = np.random.default_rng(2)
+    mu, mhigh = 29., 28.
+    data = sample_pnlf(40,mu,mhigh,rng=rng)
+    dm = np.full(len(data),0.1)
+
+    fitter = MaximumLikelihood1D(pnlf_convolved,data,mhigh=mhigh,dm=dm)
+    with pytest.raises(ValueError):
+        fitter.bootstrap()
+    fitter.fit([mu])
+
+    # the same seed gives the same samples (independent of the workers)
+    for kind in ['bootstrap','jackknife']:
+        x, plus, minus = fitter.bootstrap(n_samples=20,kind=kind,seed=1)
+        samples = fitter.samples
+        assert len(samples) == (20 if kind=='bootstrap' else len(data))
+        assert np.all(np.isfinite(samples)) and plus > 0 and minus > 0
+        assert fitter.bootstrap(n_samples=20,kind=kind,seed=1) == (x,plus,minus)
+        np.testing.assert_array_equal(fitter.samples,samples)
+        fitter.bootstrap(n_samples=20,kind=kind,seed=1,workers=2)
+        np.testing.assert_array_equal(fitter.samples,samples)
+
+    # the jackknife leaves out one data point (and its error)
+    reference = MaximumLikelihood1D(pnlf_convolved,data[1:],mhigh=mhigh,dm=dm[1:])
+    np.testing.assert_allclose(samples[0],reference.fit([fitter.x])[0],rtol=1e-6)
+
+    fitter = MaximumLikelihood1D(pnlf,data,err=dm,mhigh=mhigh)
+    fitter.fit([mu])
+    x, plus, minus = fitter.bootstrap(n_samples=20,kind='parametric',seed=1)
+    samples = fitter.samples
+    assert np.all(np.isfinite(samples)) and plus > 0 and minus > 0
+    fitter.bootstrap(n_samples=20,kind='parametric',seed=1)
+    np.testing.assert_array_equal(fitter.samples,samples)
+    fitter.bootstrap(n_samples=20,kind='parametric',seed=2)
+    assert not np.array_equal(fitter.samples,samples)
+
+
+def test_sample(tmp_path):
+
+    rng = np.random.default_rng(3)
+    mu, mhigh = 29., 28.
+    data = sample_pnlf(40,mu,mhigh,rng=rng)
+    dm = np.full(len(data),0.1)
+
+    fitter = MaximumLikelihood1D(pnlf_convolved,data,mhigh=mhigh,dm=dm)
+    x, plus, minus = fitter.fit([mu])
+
+    # the posterior agrees with the likelihood from the fit
+    result = fitter.sample(nwalkers=16,nsteps=300,seed=1)
+    assert x-minus < result[0] < x+plus
+    assert fitter.sampler.iteration == 300
+
+    # the same chain with the same seed (independent of the workers)
+    chain = fitter.chain
+    assert fitter.sample(nwalkers=16,nsteps=300,seed=1) == result
+    fitter.sample(nwalkers=16,nsteps=300,seed=1,workers=2)
+    np.testing.assert_array_equal(fitter.chain,chain)
+
+    # the chain is saved to disk and continued
+    pytest.importorskip('h5py')
+    filename = tmp_path / 'chain.h5'
+    fitter.sample(nwalkers=16,nsteps=100,filename=filename,seed=1)
+    fitter.sample(nwalkers=16,nsteps=100,filename=filename,seed=2)
+    assert fitter.sampler.iteration == 200
+    with pytest.raises(ValueError):
+        fitter.sample(nwalkers=8,nsteps=100,filename=filename)
+    fitter.sample(nwalkers=16,nsteps=100,filename=filename,resume=False)
+    assert fitter.sampler.iteration == 100
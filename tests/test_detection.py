@@ -0,0 +1,53 @@
+import numpy as np
+
+from astropy.table import Table
+
+from pnlf.detection import match_catalogues, render_sources
+
+
+def brute_force(xy_match,xy_cat):
+    '''distance between all elements of the two catalogues'''
+
+    return np.sqrt(np.sum((xy_match[:,None,:]-xy_cat[None,:,:])**2,axis=2))
+
+
+def test_match_catalogues():
+    '''
+    compare the nearest, k-nearest and radius query to the distance 
+    matrix computed by brute force
+    '''
+
+    xy_match = np.random.uniform(0,100,(200,2))
+    xy_cat   = np.random.uniform(0,100,(300,2))
+    matchcoord   = Table(xy_match,names=['x_mean','y_mean'])
+    catalogcoord = Table(xy_cat,names=['xcentroid','ycentroid'])
+
+    dist = brute_force(xy_match,xy_cat)
+
+    idx, sep = match_catalogues(matchcoord,catalogcoord)
+    np.testing.assert_array_equal(idx,np.argmin(dist,axis=1))
+    np.testing.assert_allclose(sep,np.min(dist,axis=1))
+
+    idx, sep = match_catalogues(matchcoord,catalogcoord,k=3)
+    np.testing.assert_allclose(sep,np.sort(dist,axis=1)[:,:3])
+
+    idx, sep = match_catalogues(matchcoord,catalogcoord,radius=5)
+    for i in range(len(xy_match)):
+        np.testing.assert_array_equal(np.sort(idx[i]),np.flatnonzero(dist[i]<=5))
+        np.testing.assert_allclose(sep[i],np.sort(dist[i][dist[i]<=5]))
+
+
+def test_render_sources():
+    '''the injected sources must have the specified total flux'''
+
+    x = np.array([20.,50.3,80.7])
+    y = np.array([30.,49.5,70.2])
+    flux = np.array([100.,1e3,1e4])
+
+    image = render_sources((100,100),x,y,flux,fwhm=3.5)
+    np.testing.assert_allclose(image[:40,:40].sum(),flux[0],rtol=1e-4)
+    np.testing.assert_allclose(image.sum(),flux.sum(),rtol=1e-4)
+
+    # the wings of a Moffat extend beyond the stamp
+    image = render_sources((100,100),x,y,flux,fwhm=3.5,model='moffat',alpha=2.8,size=15)
+    np.testing.assert_allclose(image.sum(),flux.sum(),rtol=1e-2)
@@ -0,0 +1,56 @@
+from pnlf.analyse import emission_line_diagnostics
+from pnlf.diagnostics import classify, classification_probabilities, hbeta_criteria
+
+import numpy as np
+from astropy.table import Table
+
+
+def test_classify():
+
+    # PN, HII region, SNR (SII) and SNR (velocity dispersion) and NaN
+    tbl = Table({'OIII5006':[1000.,100,1000,1000,np.nan],
+                 'HA6562'  :[100.,1000,1000,100,100],
+                 'NII6583' :[10.,100,100,10,10],
+                 'SII6716' :[10.,10,400,10,10],
+                 'SII6730' :[10.,10,400,10,10],
+                 'HB4861'  :[40.,400,400,40,40],
+                 'HA6562_SIGMA':[20.,20,20,150,20],
+                 'mOIII'   :[26.,26,26,26,26]})
+    for col in ['OIII5006','HA6562','NII6583','SII6716','SII6730','HB4861']:
+        tbl[f'{col}_err'] = np.ones(len(tbl))
+
+    out = emission_line_diagnostics(tbl,29.9,28)
+    assert list(out['type']) == ['PN','HII','SNR','SNR','NaN']
+    assert 'type' not in tbl.colnames
+
+    # the same result for a structured array
+    codes, types, columns = classify(tbl.as_array(),29.9)
+    np.testing.assert_equal(codes,out['type_code'])
+
+    # other criteria
+    codes, types, columns = classify(tbl,29.9,criteria=hbeta_criteria)
+    assert [types[i] for i in codes] == ['PN','HII','SNR','SNR','NaN']
+
+    # with small errors all realizations have the same type
+    probabilities, types = classification_probabilities(tbl,29.9,n_draws=10,seed=1,chunk_size=2)
+    np.testing.assert_equal(probabilities[np.arange(len(tbl)),out['type_code']],1)
+
+
+def test_copy():
+
+    tbl = Table({col:np.ones(3) for col in ['OIII5006','HA6562','NII6583','SII6716','SII6730','HB4861','mOIII']})
+    for col in ['OIII5006','HA6562','NII6583','SII6716','SII6730','HB4861']:
+        tbl[f'{col}_err'] = np.ones(len(tbl))
+    tbl['dmOIII'] = np.full(len(tbl),0.1)
+
+    # changing the output in place does not change the input
+    out = emission_line_diagnostics(tbl,29.9,28)
+    out['dmOIII'] *= 1.67
+    out['OIII5006_err'][0] = 5
+    np.testing.assert_array_equal(tbl['dmOIII'],0.1)
+    np.testing.assert_array_equal(tbl['OIII5006_err'],1)
+
+    # unless the columns are shared on purpose
+    out = emission_line_diagnostics(tbl,29.9,28,copy=False)
+    out['dmOIII'] *= 2
+    np.testing.assert_array_equal(tbl['dmOIII'],0.2)
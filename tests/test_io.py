@@ -0,0 +1,149 @@
+import os
+import numpy as np
+
+from astropy.io import fits
+
+import pnlf.io
+from pnlf.io import ReadLineMaps
+
+lines = ['OIII5006','HA6562']
+
+
+def write_maps(folder,name='NGC0000',shape=(20,30),aux=False):
+    '''write a small file with the same extensions as the MUSEDAP
+
+    with `aux=True` a seeing map and a star mask are also written
+    '''
+
+    rng = np.random.default_rng(1)
+    header = fits.Header({'CTYPE1':'RA---TAN','CTYPE2':'DEC--TAN','CDELT1':-5e-5,'CDELT2':5e-5,
+                          'CRVAL1':10.,'CRVAL2':10.,'CRPIX1':15.,'CRPIX2':10.})
+    hdus = [fits.PrimaryHDU()]
+    for ext in ['FLUX','SNR','V_STARS','STELLAR_MASS_DENSITY','STELLAR_MASS_DENSITY_err','EBV_STARS']:
+        hdus.append(fits.ImageHDU(rng.normal(size=shape),header=header,name=ext))
+    for line in lines:
+        for ext in ['FLUX','FLUX_ERR','SIGMA_ERR']:
+            hdus.append(fits.ImageHDU(rng.normal(size=shape),name=f'{line}_{ext}'))
+        hdus.append(fits.ImageHDU(rng.uniform(50,100,shape),name=f'{line}_SIGMA'))
+        hdus.append(fits.ImageHDU(rng.uniform(0,40,shape),name=f'{line}_SIGMA_CORR'))
+
+    folder.mkdir(parents=True)
+    fits.HDUList(hdus).writeto(folder / f'{name}_MAPS.fits')
+
+    if aux:
+        # seeing (two pointings) and star mask in the auxiliary folder
+        seeing = np.where(np.arange(shape[1])<shape[1]//2,0.8,1.0) * np.ones(shape)
+        star_mask = np.zeros(shape)
+        star_mask[5:8,5:8] = 1
+        for sub,suffix,data in [('seeing_maps','seeing',seeing),('starmasks','starmask',star_mask)]:
+            (folder.parent / 'AUXILIARY' / sub).mkdir(parents=True)
+            fits.PrimaryHDU(data,header=header).writeto(folder.parent / 'AUXILIARY' / sub / f'{name}_{suffix}.fits')
+
+    return name
+
+
+def test_lazy(tmp_path):
+
+    name = write_maps(tmp_path / 'MUSEDAP',aux=True)
+    eager = ReadLineMaps(tmp_path / 'MUSEDAP',name,extensions=lines)
+    lazy  = ReadLineMaps(tmp_path / 'MUSEDAP',name,extensions=lines,lazy=True)
+
+    for line in lines:
+        for k in [line,f'{line}_err',f'{line}_SIGMA',f'{line}_SIGMA_ERR']:
+            assert isinstance(getattr(lazy,k),np.ndarray)
+            np.testing.assert_array_equal(getattr(lazy,k),getattr(eager,k))
+    np.testing.assert_array_equal(lazy.star_mask,eager.star_mask)
+    np.testing.assert_array_equal(lazy.PSF,eager.PSF)
+    assert np.sum(lazy.star_mask) == 9
+
+    # all remaining maps are loaded before the file is closed
+    lazy.close()
+    assert not hasattr(lazy,'_hdul')
+    np.testing.assert_array_equal(lazy.stellar_mass,eager.stellar_mass)
+
+    # without the auxiliary files the star mask has the same type as the maps
+    name = write_maps(tmp_path / 'other' / 'MUSEDAP')
+    lazy = ReadLineMaps(tmp_path / 'other' / 'MUSEDAP',name,extensions=lines,lazy=True)
+    assert lazy.star_mask.dtype == lazy.OIII5006.dtype
+
+
+def test_reproject_cached(tmp_path,monkeypatch):
+
+    calls = []
+    def reproject_interp(hdu,header):
+        calls.append(header)
+        return np.zeros((header['NAXIS2'],header['NAXIS1'])), None
+    monkeypatch.setattr(pnlf.io,'reproject_interp',reproject_interp)
+
+    filename = tmp_path / 'map.fits'
+    fits.PrimaryHDU(np.ones((5,5))).writeto(filename)
+    header = fits.Header({'NAXIS':2,'NAXIS1':4,'NAXIS2':3,'CTYPE1':'RA---TAN','CTYPE2':'DEC--TAN',
+                          'CRVAL1':10.,'CRVAL2':10.,'CRPIX1':2.,'CRPIX2':2.,'CDELT1':-5e-5,'CDELT2':5e-5})
+
+    # the first call reprojects, the second reads from the cache
+    pnlf.io.reproject_cached(filename,header)
+    pnlf.io.reproject_cached(filename,header)
+    assert len(calls) == 1
+    assert len(list((tmp_path / 'reprojected').iterdir())) == 1
+
+    # a different target WCS
+    header['CRPIX1'] = 3.
+    pnlf.io.reproject_cached(filename,header)
+    assert len(calls) == 2
+
+    # a modified input file
+    stat = filename.stat()
+    os.utime(filename,ns=(stat.st_atime_ns,stat.st_mtime_ns+10**9))
+    pnlf.io.reproject_cached(filename,header)
+    assert len(calls) == 3
+
+    # without cache
+    pnlf.io.reproject_cached(filename,header,cache=False)
+    assert len(calls) == 4
+
+    # an interrupted write leaves neither a cache file nor a temporary file
+    def save(file,data):
+        file.write(b'truncated')
+        raise OSError('disk full')
+    monkeypatch.setattr(pnlf.io.np,'save',save)
+    header['CRPIX1'] = 4.
+    pnlf.io.reproject_cached(filename,header)
+    monkeypatch.undo()
+    monkeypatch.setattr(pnlf.io,'reproject_interp',reproject_interp)
+    assert len(list((tmp_path / 'reprojected').iterdir())) == 3
+    pnlf.io.reproject_cached(filename,header)
+    assert len(calls) == 6
+    assert len(list((tmp_path / 'reprojected').iterdir())) == 4
+
+
+def test_close_without_loading(tmp_path):
+
+    name = write_maps(tmp_path / 'MUSEDAP')
+    lazy = ReadLineMaps(tmp_path / 'MUSEDAP',name,extensions=lines,lazy=True)
+    OIII = lazy.OIII5006
+
+    # maps that were not accessed are discarded
+    lazy.close(load=False)
+    assert not hasattr(lazy,'_hdul')
+    assert not hasattr(lazy,'HA6562')
+    assert lazy.OIII5006 is OIII
+
+
+def test_stack_lines(tmp_path):
+
+    name = write_maps(tmp_path / 'MUSEDAP')
+    maps    = ReadLineMaps(tmp_path / 'MUSEDAP',name,extensions=lines)
+    stacked = ReadLineMaps(tmp_path / 'MUSEDAP',name,extensions=lines,stacked=True)
+
+    # the maps are views of the cube with the same values
+    for i,line in enumerate(stacked.cube_lines):
+        for k,cube in [(line,stacked.cube),(f'{line}_err',stacked.cube_err)]:
+            assert getattr(stacked,k).base is cube
+            assert np.shares_memory(getattr(stacked,k),cube[i])
+            assert getattr(stacked,k).dtype == getattr(maps,k).dtype.newbyteorder('=')
+            np.testing.assert_array_equal(getattr(stacked,k),getattr(maps,k))
+
+    # with a smaller data type the values are rounded
+    cube = maps.stack_lines(dtype=np.float32)
+    assert cube.dtype == np.float32
+    assert maps.OIII5006.base is cube
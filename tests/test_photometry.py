@@ -1,13 +1,16 @@
 import numpy as np
 
 
+from astropy.table import Table
 from astropy.modeling import models, fitting 
 from astropy.stats import gaussian_fwhm_to_sigma
 
-from photutils import aperture_photometry, CircularAperture
+from astropy.stats import sigma_clipped_stats
+from photutils import aperture_photometry, CircularAperture, CircularAnnulus
 
-from pnlf.photometry import growth_curve
-from pnlf.auxiliary import light_in_gaussian
+from pnlf.photometry import growth_curve, growth_curves, measure_flux, batch_sigma_clipped_stats
+from pnlf.photometry import measure_single_flux, batch_measure_single_flux
+from pnlf.auxiliary import light_in_gaussian, light_in_moffat, correct_PSF
 
 
 def test_growth_curve():
@@ -29,6 +32,48 @@ def test_growth_curve():
     assert abs(fwhm-fwhm_fit)/fwhm < 0.05
 
 
+def test_growth_curves():
+    '''
+    fit the growth curves of multiple stars in one image at once
+    '''
+
+    size = 64
+    
+    fwhm = np.random.uniform(4,8,4)
+    x = np.array([size/2,3*size/2,size/2,3*size/2]) + np.random.uniform(-0.5,0.5,4)
+    y = np.array([size/2,size/2,3*size/2,3*size/2]) + np.random.uniform(-0.5,0.5,4)
+    img = np.zeros((2*size,2*size))
+    for f,xc,yc in zip(fwhm,x,y):
+        std = f * gaussian_fwhm_to_sigma
+        gaussian = models.Gaussian2D(x_mean=xc,y_mean=yc,x_stddev=std,y_stddev=std)
+        img += gaussian(*np.indices(img.shape)[::-1])
+
+    fwhm_fit = growth_curves(img,x,y,model='gaussian',rmax=25)['fwhm']
+
+    assert np.all(np.abs(fwhm-fwhm_fit)/fwhm < 0.05)
+
+
+def test_growth_curves_background():
+    '''
+    the background must be subtracted from the same pixels that are 
+    summed (otherwise the small radii and hence the FWHM are biased)
+    '''
+
+    size = 64
+
+    fwhm = np.array([4.,5.,6.,7.])
+    x = np.array([size/2,3*size/2,size/2,3*size/2]) + np.random.uniform(-0.5,0.5,4)
+    y = np.array([size/2,size/2,3*size/2,3*size/2]) + np.random.uniform(-0.5,0.5,4)
+    img = np.full((2*size,2*size),0.2)
+    for f,xc,yc in zip(fwhm,x,y):
+        std = f * gaussian_fwhm_to_sigma
+        gaussian = models.Gaussian2D(x_mean=xc,y_mean=yc,x_stddev=std,y_stddev=std)
+        img += gaussian(*np.indices(img.shape)[::-1])
+
+    fwhm_fit = growth_curves(img,x,y,model='gaussian',rmax=25)['fwhm']
+
+    assert np.all(np.abs(fwhm-fwhm_fit)/fwhm < 0.04)
+
 
 def test_aperture_correction():
     '''
@@ -54,4 +99,115 @@ def test_aperture_correction():
 
     corrected_flux =  partial_flux / light_in_gaussian(r,fwhm)
 
-    assert abs(corrected_flux-total_flux) / total_flux < 0.05
\ No newline at end of file
+    assert abs(corrected_flux-total_flux) / total_flux < 0.05
+
+def test_batch_sigma_clipped_stats():
+    '''
+    the statistics of samples of different size (padded with NaN) must
+    be the same as from `sigma_clipped_stats` for each sample
+    '''
+
+    rng = np.random.default_rng(2)
+    samples = [rng.normal(10,1,n) for n in [5,40,150,300]]
+    # some outliers that are clipped
+    samples[2][:10] += 20
+    samples[3][:5]  -= 30
+    data = np.full((len(samples),300),np.nan)
+    for row,sample in zip(data,samples):
+        row[:len(sample)] = sample
+    data[1,50:60] = 10.
+
+    for maxiters in [1,3,None]:
+        mean, median, std = batch_sigma_clipped_stats(data,sigma=3,maxiters=maxiters)
+        for i,row in enumerate(data):
+            reference = sigma_clipped_stats(row[~np.isnan(row)],sigma=3,maxiters=maxiters)
+            np.testing.assert_allclose((mean[i],median[i],std[i]),reference,rtol=1e-12)
+
+    # a sample without valid values
+    assert np.all(np.isnan(batch_sigma_clipped_stats(np.full((1,5),np.nan))))
+
+
+class Galaxy:
+    '''the attributes of `ReadLineMaps` that are used by `measure_flux`'''
+
+    def __init__(self,shape=(80,100),seed=1):
+
+        rng = np.random.default_rng(seed)
+        self.name  = 'NGC0000'
+        self.lines = ['OIII5006','HA6562']
+        for line in self.lines:
+            setattr(self,line,rng.normal(10,1,shape))
+            setattr(self,f'{line}_err',rng.uniform(0.5,1.5,shape))
+            setattr(self,f'{line}_SIGMA',rng.uniform(10,50,shape))
+        self.stellar_mass = rng.uniform(0,1,shape)
+
+
+def test_measure_flux():
+    '''
+    compare the aperture sums and the background to the values from 
+    `aperture_photometry` and `sigma_clipped_stats` for sources in the
+    interior and at the edge of the image (the annulus of the latter 
+    only contains the pixels inside of the image)
+    '''
+
+    galaxy = Galaxy()
+    fwhm = 4.
+    aperture_size = 2.5
+    peak_tbl = Table({'x':[50.3,30.7,70.1,1.5,98.2,40.6],
+                      'y':[40.2,20.5,60.9,40.3,3.1,78.8],
+                      'fwhm':np.full(6,fwhm)})
+
+    flux = measure_flux(galaxy,peak_tbl,alpha=2.3,Rv=3.1,Ebv=0,aperture_size=aperture_size)
+
+    positions = np.transpose((peak_tbl['x'],peak_tbl['y']))
+    for line in galaxy.lines:
+        data, error = getattr(galaxy,line), getattr(galaxy,f'{line}_err')
+        PSF_correction = correct_PSF(int(line[-4:]))
+        r = aperture_size * (fwhm-PSF_correction) / 2 
+        phot = aperture_photometry(data,CircularAperture(positions,r=r),error=error)
+        np.testing.assert_allclose(flux[f'{line}_aperture_sum'],phot['aperture_sum'],rtol=1e-10)
+        np.testing.assert_allclose(flux[f'{line}_err'],phot['aperture_sum_err'],rtol=1e-10)
+
+        r_in  = 4 * (fwhm-PSF_correction) / 2 
+        annulus = CircularAnnulus(positions,r_in=r_in,r_out=np.sqrt(5*r**2+r_in**2))
+        pixels = [mask.get_values(data) for mask in annulus.to_mask(method='center')]
+        # `bkg_median` is the sigma clipped mean (as in the original implementation)
+        bkg_median = [sigma_clipped_stats(p,sigma=3,maxiters=3)[0] for p in pixels]
+        np.testing.assert_allclose(flux[f'{line}_bkg_median'],bkg_median,rtol=1e-10)
+        np.testing.assert_allclose(flux[f'{line}_bkg_global'],[np.median(p)*np.pi*r**2 for p in pixels],rtol=1e-10)
+
+
+def single_flux(img,position,aperture_size,alpha,gamma):
+    '''the flux of a single source with a Moffat (one source at a time)'''
+
+    fwhm = 2 * gamma * np.sqrt(2**(1/alpha)-1)
+    r = aperture_size * fwhm / 2 
+    aperture_sum = aperture_photometry(img,CircularAperture(position,r=r))['aperture_sum'][0]
+
+    r_in  = 4 * fwhm / 2 
+    mask = CircularAnnulus(position,r_in=r_in,r_out=np.sqrt(3*r**2+r_in**2)).to_mask(method='center')
+    _, bkg_median, _ = sigma_clipped_stats(mask.get_values(img),sigma=3,maxiters=1)
+
+    return (aperture_sum - bkg_median*np.pi*r**2) / light_in_moffat(r,alpha,gamma)
+
+
+def test_batch_measure_single_flux():
+    '''
+    compare the fluxes of many sources (with different PSFs) to the
+    measurement of each source on its own
+    '''
+
+    rng = np.random.default_rng(3)
+    img = rng.normal(5,1,(80,100))
+    x = np.array([50.3,30.7,70.1,1.5,98.2,40.6])
+    y = np.array([40.2,20.5,60.9,40.3,3.1,78.8])
+    alpha = np.array([2.3,2.3,2.8,2.3,2.8,2.3])
+    gamma = np.array([2.,2.,2.5,2.,2.5,3.])
+
+    phot = batch_measure_single_flux(img,x,y,2.5,model='Moffat',alpha=alpha,gamma=gamma)
+    reference = [single_flux(img,(xi,yi),2.5,a,g) for xi,yi,a,g in zip(x,y,alpha,gamma)]
+    np.testing.assert_allclose(phot['flux'],reference,rtol=1e-10)
+
+    # the single source version
+    flux = measure_single_flux(img,(x[0],y[0]),2.5,model='Moffat',alpha=alpha[0],gamma=gamma[0])
+    np.testing.assert_allclose(flux,reference[0],rtol=1e-10)
@@ -0,0 +1,61 @@
+import numpy as np
+
+from astropy.io import fits
+
+from pnlf.detection import render_sources
+from pnlf.pipeline import run_pipeline
+from pnlf.sampling import sample_pnlf
+
+lines = ['HB4861','OIII5006','HA6562','NII6583','SII6716','SII6730']
+parameters = {'NGC0000':{'mu':29.9,'power_index':2.3,'completeness_limit':28.}}
+
+
+def write_galaxy(folder,name='NGC0000',shape=(120,160),n_sources=40):
+    '''a galaxy with PNs (only in OIII) and the same files as the MUSEDAP'''
+
+    rng = np.random.default_rng(4)
+    header = fits.Header({'CTYPE1':'RA---TAN','CTYPE2':'DEC--TAN','CDELT1':-5.5e-5,'CDELT2':5.5e-5,
+                          'CRVAL1':10.,'CRVAL2':10.,'CRPIX1':80.,'CRPIX2':60.})
+
+    # the sources are on a grid so they do not overlap
+    y, x = np.mgrid[10:shape[0]-5:14,10:shape[1]-5:14].reshape(2,-1)[:,:n_sources].astype(float)
+    x += rng.uniform(-1,1,len(x))
+    y += rng.uniform(-1,1,len(y))
+    flux = 10**(-(sample_pnlf(len(x),29.9,27.5,rng=rng)+13.74)/2.5) * 1e20
+    
+    hdus = [fits.PrimaryHDU()]
+    for ext in ['FLUX','SNR','V_STARS','STELLAR_MASS_DENSITY','STELLAR_MASS_DENSITY_err','EBV_STARS']:
+        hdus.append(fits.ImageHDU(rng.uniform(1,2,shape),header=header,name=ext))
+    for line in lines:
+        data = rng.normal(0,1,shape)
+        if line == 'OIII5006':
+            data = render_sources(shape,x,y,flux,fwhm=4,model='moffat',alpha=2.3,image=data)
+        hdus.append(fits.ImageHDU(data,header=header,name=f'{line}_FLUX'))
+        hdus.append(fits.ImageHDU(np.ones(shape),header=header,name=f'{line}_FLUX_ERR'))
+        hdus.append(fits.ImageHDU(rng.uniform(50,60,shape),name=f'{line}_SIGMA'))
+        hdus.append(fits.ImageHDU(rng.uniform(0,40,shape),name=f'{line}_SIGMA_CORR'))
+        hdus.append(fits.ImageHDU(np.ones(shape),name=f'{line}_SIGMA_ERR'))
+    folder.mkdir(parents=True)
+    fits.HDUList(hdus).writeto(folder / f'{name}_MAPS.fits')
+
+    # seeing map (0.8" = 4 pixel) and star mask
+    for sub,suffix,data in [('seeing_maps','seeing',np.full(shape,0.8)),('starmasks','starmask',np.zeros(shape))]:
+        (folder.parent / 'AUXILIARY' / sub).mkdir(parents=True)
+        fits.PrimaryHDU(data,header=header).writeto(folder.parent / 'AUXILIARY' / sub / f'{name}_{suffix}.fits')
+
+    return name
+
+
+def test_run_pipeline(tmp_path):
+
+    name = write_galaxy(tmp_path / 'MUSEDAP')
+    output = tmp_path / 'reports'
+
+    results = run_pipeline(parameters,tmp_path / 'MUSEDAP',workers=1,output=output)
+
+    assert list(results['name']) == [name]
+    assert results['N_PN'][0] > 20
+    assert abs(results['mu'][0]-29.9) < 0.5
+    assert (output / name / f'{name}_pn_candidates.txt').is_file()
+    assert (output / name / f'{name}_PNLF.pdf').is_file()
+    assert (output / name / f'{name}.log').is_file()
@@ -0,0 +1,40 @@
+from pnlf.analyse import cdf
+from pnlf.sampling import inverse_cdf, sample_pnlf, sample_numerical
+
+import numpy as np
+from scipy.stats import kstest
+
+
+def test_inverse_cdf():
+
+    mu, mhigh, Mmax = 29., 28., -4.47
+    mlow = mu+Mmax
+
+    # including the bright cutoff (where the PNLF goes to zero) and mhigh
+    m = mlow + np.array([0,1e-6,1e-4,1e-3,0.01,0.1,0.5,1,2,3,mhigh-mlow])
+    np.testing.assert_allclose(inverse_cdf(cdf(m,mu,mhigh),mu,mhigh),m,rtol=0,atol=1e-8)
+    np.testing.assert_array_equal(inverse_cdf(np.array([0.,1.]),mu,mhigh),[mlow,mhigh])
+
+    # away from the cutoff the inverse is exact to numerical precision
+    m = np.linspace(mlow+0.05,mhigh,100)
+    np.testing.assert_allclose(inverse_cdf(cdf(m,mu,mhigh),mu,mhigh),m,rtol=0,atol=1e-10)
+
+    # other Mmax
+    m = np.linspace(mu-4.3,mhigh,50)
+    np.testing.assert_allclose(inverse_cdf(cdf(m,mu,mhigh,Mmax=-4.3),mu,mhigh,Mmax=-4.3),m,rtol=0,atol=1e-8)
+
+
+def test_sample_pnlf():
+
+    mu, mhigh = 29., 28.
+    rng = np.random.default_rng(1)
+
+    m = sample_pnlf(10000,mu,mhigh,rng=rng)
+    assert np.all((m>=mu-4.47) & (m<=mhigh))
+    assert kstest(m,lambda x: cdf(np.asarray(x),mu,mhigh)).pvalue > 0.01
+
+    # the same for a numerical PDF
+    x = np.linspace(mu-4.47,mhigh,2000)
+    y = np.gradient(cdf(x,mu,mhigh),x)
+    m = sample_numerical(x,y,N=10000,rng=rng)
+    assert kstest(m,lambda x: cdf(np.asarray(x),mu,mhigh)).pvalue > 0.01